@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# file:        bench_escape.py
+# description: Benchmark of the escaping of the text of the pages.
+
+# Copyright (C) 2007-12 Andrea Vedaldi and Brian Fulkerson.
+# All rights reserved.
+#
+# This file is part of the VLFeat library and is made available under
+# the terms of the BSD license (see the COPYING file).
+
+import os
+import imp
+import time
+import random
+import htmlentitydefs
+import xml.sax.saxutils
+
+from optparse import OptionParser
+
+usage = """bench_escape.py [OPTIONS...] [DOC.XML]
+
+Compare escapeXMLString() with the escaping it replaced,
+xml.sax.saxutils.escape() with the HTML entity map. Both are first
+checked to give the same output on random strings; they are then
+timed on the text nodes of DOC.XML, or on a set of typical text nodes.
+
+--webdoc   The webdoc.py to measure (default: the one of this tree)
+--repeat   Number of times each text is escaped
+"""
+
+parser = OptionParser(usage=usage)
+
+parser.add_option(
+    "--webdoc",
+    dest    = "webdoc",
+    default = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, "webdoc.py"),
+    action  = "store",
+    help    = "measure this version of webdoc.py")
+
+parser.add_option(
+    "--repeat",
+    dest    = "repeat",
+    default = 10,
+    action  = "store",
+    type    = "int",
+    help    = "escape each text this number of times")
+
+# Text nodes as found in the documentation: mostly ASCII prose and
+# indentation, some Latin-1 and symbols
+sampleTexts = [
+    u"The function returns the number of elements in the array.\n  ",
+    u"  See the documentation of vl_sift & vl_dsift <details>.\n",
+    u"Caf\xe9 na\xefve r\xe9sum\xe9 — α + β = γ\n",
+    u"\n    ",
+    u"x"]
+
+def getDocumentTexts(webdoc, filePath):
+    """
+    Returns the content of the text nodes of the document FILEPATH.
+    """
+    handler = webdoc.DocHandler()
+    handler.verbosity = 0
+    handler.load(filePath)
+    texts = []
+    stack = [handler.rootNode]
+    while len(stack) > 0:
+        node = stack.pop()
+        if isinstance(node, webdoc.DocHtmlText):
+            texts.append(node.text)
+        stack.extend(getattr(node, "children", []))
+    return texts
+
+def checkEquivalence(escape, oldEscape, numStrings = 20000):
+    """
+    Check that ESCAPE and OLDESCAPE agree on NUMSTRINGS random strings
+    of markup, entity and non-Latin characters.
+    """
+    alphabet = list(u"abc &<>\"'%;\n") + \
+        [unichr(c) for c in htmlentitydefs.codepoint2name] + \
+        [u"中", u"\U0001f600"]
+    random.seed(0)
+    for i in xrange(numStrings):
+        text = u"".join(random.choice(alphabet)
+                        for j in xrange(random.randint(0, 40)))
+        if escape(text) != oldEscape(text):
+            raise AssertionError("the escaped strings differ for %r" % text)
+    if escape("plain & str") != oldEscape("plain & str"):
+        raise AssertionError("the escaped strings differ for a byte string")
+
+def timeEscape(escape, texts, repeat):
+    """
+    Returns the time taken by ESCAPE per text of TEXTS, best of REPEAT.
+    """
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        for text in texts: escape(text)
+        elapsed = time.time() - start
+        if best is None or elapsed < best: best = elapsed
+    return best / len(texts)
+
+# --------------------------------------------------------------------
+if __name__ == '__main__':
+# --------------------------------------------------------------------
+    (opts, args) = parser.parse_args()
+
+    webdoc = imp.load_source("webdoc", opts.webdoc)
+
+    def oldEscape(text):
+        return xml.sax.saxutils.escape(text, webdoc.mapUnicodeToHtmlEntity)
+
+    if len(args) > 0:
+        texts = getDocumentTexts(webdoc, args[0])
+    else:
+        texts = sampleTexts * 2000
+
+    checkEquivalence(webdoc.escapeXMLString, oldEscape)
+    print "escapeXMLString gives the same output as saxutils.escape"
+    print "%d text nodes, %d characters" % (
+        len(texts), sum(len(x) for x in texts))
+    for name, escape in [("saxutils.escape", oldEscape),
+                         ("escapeXMLString", webdoc.escapeXMLString)]:
+        print "%-16s %8.2f us/node" % (
+            name, timeEscape(escape, texts, opts.repeat) * 1e6)
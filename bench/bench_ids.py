@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# file:        bench_ids.py
+# description: Benchmark of the allocation of the generated node IDs.
+
+# Copyright (C) 2007-12 Andrea Vedaldi and Brian Fulkerson.
+# All rights reserved.
+#
+# This file is part of the VLFeat library and is made available under
+# the terms of the BSD license (see the COPYING file).
+
+import os
+import gc
+import imp
+import time
+import shutil
+import tempfile
+
+from optparse import OptionParser
+
+usage = """bench_ids.py [OPTIONS...] [N...]
+
+Parse documents made of N HTML elements without an ID (by default
+10k, 100k and 1M) and report the time per node, which stays constant
+if the IDs are allocated in constant time.
+
+--webdoc   The webdoc.py to measure (default: the one of this tree)
+--no-gc    Disable the cyclic garbage collector while parsing
+"""
+
+parser = OptionParser(usage=usage)
+
+parser.add_option(
+    "--webdoc",
+    dest    = "webdoc",
+    default = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, "webdoc.py"),
+    action  = "store",
+    help    = "measure this version of webdoc.py")
+
+parser.add_option(
+    "--no-gc",
+    dest    = "nogc",
+    default = False,
+    action  = "store_true",
+    help    = "disable the cyclic garbage collector while parsing")
+
+# --------------------------------------------------------------------
+def writeFlatDocument(filePath, numNodes):
+# --------------------------------------------------------------------
+    """
+    Write to FILEPATH a page with NUMNODES HTML elements, none of
+    which has an ID.
+    """
+    f = open(filePath, "w")
+    try:
+        f.write('<site>\n<page name="index" title="Flat">\n<div>\n')
+        for i in xrange(numNodes - 1):
+            f.write('<p/>\n')
+        f.write('</div>\n</page>\n</site>\n')
+    finally:
+        f.close()
+
+def parseDocument(webdoc, filePath):
+    """
+    Load FILEPATH with a new DocHandler and return the time taken.
+    """
+    webdoc.nodeIndex.clear()
+    if hasattr(webdoc, "resetDocumentState"):
+        webdoc.resetDocumentState()
+    handler = webdoc.DocHandler()
+    handler.verbosity = 0
+    start = time.time()
+    handler.load(filePath)
+    return time.time() - start
+
+# --------------------------------------------------------------------
+if __name__ == '__main__':
+# --------------------------------------------------------------------
+    (opts, args) = parser.parse_args()
+    sizes = [int(x) for x in args] or [10000, 100000, 1000000]
+
+    webdoc = imp.load_source("webdoc", opts.webdoc)
+    if opts.nogc: gc.disable()
+
+    tempDir = tempfile.mkdtemp()
+    try:
+        print "%10s %10s %12s" % ("elements", "time (s)", "us/element")
+        for numNodes in sizes:
+            filePath = os.path.join(tempDir, "flat%d.xml" % numNodes)
+            writeFlatDocument(filePath, numNodes)
+            elapsed = parseDocument(webdoc, filePath)
+            print "%10d %10.3f %12.2f" % (numNodes, elapsed,
+                                          elapsed / numNodes * 1e6)
+            os.remove(filePath)
+    finally:
+        shutil.rmtree(tempDir)
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# file:        bench_parser.py
+# description: Benchmark of the parser backends (sax and expat).
+
+# Copyright (C) 2007-12 Andrea Vedaldi and Brian Fulkerson.
+# All rights reserved.
+#
+# This file is part of the VLFeat library and is made available under
+# the terms of the BSD license (see the COPYING file).
+
+import os
+import sys
+import imp
+import time
+import shutil
+import tempfile
+import resource
+import subprocess
+
+from optparse import OptionParser
+
+usage = """bench_parser.py [OPTIONS...] [DOC.XML]
+
+Load DOC.XML, or a generated site, with each parser backend and report
+the number of document nodes, the nodes parsed per second and the peak
+memory. Each backend runs in a process of its own, so that the peak
+memory of one does not hide the other.
+
+--webdoc       The webdoc.py to measure (default: the one of this tree)
+--pages        Number of pages of the generated site
+--repeat       Number of loads per backend (the best time is reported)
+--compact-dtd  Use built-in tables instead of reading the XHTML DTD files
+"""
+
+parser = OptionParser(usage=usage)
+
+parser.add_option(
+    "--webdoc",
+    dest    = "webdoc",
+    default = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, "webdoc.py"),
+    action  = "store",
+    help    = "measure this version of webdoc.py")
+
+parser.add_option(
+    "--pages",
+    dest    = "pages",
+    default = 600,
+    action  = "store",
+    type    = "int",
+    help    = "number of pages of the generated site")
+
+parser.add_option(
+    "--repeat",
+    dest    = "repeat",
+    default = 3,
+    action  = "store",
+    type    = "int",
+    help    = "load the document this number of times per backend")
+
+parser.add_option(
+    "--compact-dtd",
+    dest    = "compactdtd",
+    default = False,
+    action  = "store_true",
+    help    = "use the compact DTDs (see webdoc --compact-dtd)")
+
+parser.add_option(
+    "--backend",
+    dest    = "backend",
+    default = None,
+    action  = "store",
+    help    = "(internal) measure this backend in the current process")
+
+doctype = '<!DOCTYPE group PUBLIC ' \
+    '"-//W3C//DTD XHTML 1.0 Transitional//EN" ' \
+    '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">\n'
+
+# --------------------------------------------------------------------
+def writeSite(siteDir, numPages, pagesPerFile = 30):
+# --------------------------------------------------------------------
+    """
+    Write to SITEDIR a site of NUMPAGES pages, with PAGESPERFILE pages
+    per included file, and return the path of its main document. The
+    pages have entity references, links and code, as the manuals do.
+    """
+    f = open(os.path.join(siteDir, "index.xml"), "w")
+    f.write(doctype + "<site>\n")
+    for first in xrange(0, numPages, pagesPerFile):
+        f.write('<dir name="d%d">\n' % first)
+        f.write('<page id="p%d" name="index" title="Section %d">\n'
+                % (first, first))
+        f.write('<include src="s%d.xml"/>\n</page>\n</dir>\n' % first)
+        g = open(os.path.join(siteDir, "s%d.xml" % first), "w")
+        g.write(doctype + "<group>\n")
+        for i in xrange(first + 1, min(first + pagesPerFile, numPages)):
+            g.write('<page id="p%d" name="p%d" title="Page %d &amp; more">\n'
+                    % (i, i, i))
+            for k in xrange(20):
+                g.write('<h2 id="h%d-%d">Heading %d</h2>'
+                        '<p>Some text with caf&eacute; and a '
+                        '<a href="%%pathto:p%d;">link</a> &mdash; '
+                        '<b>bold</b> <i>it</i>.</p>\n'
+                        % (i, k, k, (i * 7 + k) % numPages))
+            g.write('<precode type="c">int f%d(int x) '
+                    '{ return x &lt; %d; }</precode>\n' % (i, i))
+            g.write('<ul>' + ''.join('<li>item %d</li>' % k
+                                     for k in xrange(10)) + '</ul>\n')
+            g.write('</page>\n')
+        g.write('</group>\n')
+        g.close()
+    f.write('</site>\n')
+    f.close()
+    return os.path.join(siteDir, "index.xml")
+
+def countNodes(rootNode):
+    """
+    Returns the number of nodes of the tree rooted at ROOTNODE,
+    including the text nodes.
+    """
+    count = 0
+    stack = [rootNode]
+    while len(stack) > 0:
+        node = stack.pop()
+        count += 1
+        stack.extend(getattr(node, "children", []))
+    return count
+
+def measureBackend(opts, filePath):
+    """
+    Load FILEPATH with the backend OPTS.BACKEND and print the number of
+    nodes, the best load time, and the peak memory of the process.
+    """
+    webdoc = imp.load_source("webdoc", opts.webdoc)
+    best = None
+    for i in xrange(opts.repeat):
+        webdoc.resetDocumentState()
+        webdoc.parseCache.entries.clear()
+        handler = webdoc.DocHandler()
+        handler.verbosity = 0
+        handler.setCompactDTD(opts.compactdtd)
+        handler.setParserBackend(opts.backend)
+        start = time.time()
+        handler.load(filePath)
+        elapsed = time.time() - start
+        if best is None or elapsed < best: best = elapsed
+        numNodes = countNodes(handler.rootNode)
+        handler = None
+    peakMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin": peakMemory /= 1024
+    print "%-8s %10d %10.2f %12d %10d" % (
+        opts.backend, numNodes, best, numNodes / best, peakMemory / 1024)
+
+# --------------------------------------------------------------------
+if __name__ == '__main__':
+# --------------------------------------------------------------------
+    (opts, args) = parser.parse_args()
+
+    if opts.backend is not None:
+        measureBackend(opts, args[0])
+        sys.exit(0)
+
+    tempDir = None
+    if len(args) > 0:
+        filePath = args[0]
+    else:
+        tempDir = tempfile.mkdtemp()
+        filePath = writeSite(tempDir, opts.pages)
+    try:
+        print "%-8s %10s %10s %12s %10s" % (
+            "backend", "nodes", "time (s)", "nodes/s", "peak (MB)")
+        sys.stdout.flush()
+        for backend in ["sax", "expat"]:
+            command = [sys.executable, os.path.abspath(__file__),
+                       "--webdoc", opts.webdoc,
+                       "--repeat", str(opts.repeat),
+                       "--backend", backend, filePath]
+            if opts.compactdtd: command.append("--compact-dtd")
+            if subprocess.call(command) != 0: sys.exit(-1)
+    finally:
+        if tempDir is not None: shutil.rmtree(tempDir)
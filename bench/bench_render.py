@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# file:        bench_render.py
+# description: Benchmark of the rendering of deep and wide node trees.
+
+# Copyright (C) 2007-12 Andrea Vedaldi and Brian Fulkerson.
+# All rights reserved.
+#
+# This file is part of the VLFeat library and is made available under
+# the terms of the BSD license (see the COPYING file).
+
+import os
+import imp
+import time
+
+from optparse import OptionParser
+
+usage = """bench_render.py [OPTIONS...]
+
+Render in memory a page made of DEPTH nested <div> elements, and a
+page with a list of WIDTH items, and report the time taken. A version
+of webdoc that publishes the nodes recursively fails on the first
+one with a RuntimeError (maximum recursion depth exceeded).
+
+--webdoc   The webdoc.py to measure (default: the one of this tree)
+--depth    Nesting depth of the deep page
+--width    Number of list items of the wide page
+"""
+
+parser = OptionParser(usage=usage)
+
+parser.add_option(
+    "--webdoc",
+    dest    = "webdoc",
+    default = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, "webdoc.py"),
+    action  = "store",
+    help    = "measure this version of webdoc.py (it must have "
+              "CaptureGenerator, i.e. support --jobs)")
+
+parser.add_option(
+    "--depth",
+    dest    = "depth",
+    default = 10000,
+    action  = "store",
+    type    = "int",
+    help    = "nesting depth of the deep page")
+
+parser.add_option(
+    "--width",
+    dest    = "width",
+    default = 1000000,
+    action  = "store",
+    type    = "int",
+    help    = "number of list items of the wide page")
+
+# --------------------------------------------------------------------
+def buildPage(webdoc, kind, size):
+# --------------------------------------------------------------------
+    """
+    Returns a page with SIZE nested <div> elements (KIND "deep") or a
+    list of SIZE items (KIND "wide").
+    """
+    webdoc.nodeIndex.clear()
+    if hasattr(webdoc, "resetDocumentState"):
+        webdoc.resetDocumentState()
+    site = webdoc.DocSite({}, "bench.xml", None)
+    page = webdoc.DocPage({u"name": u"bench"}, "bench.xml", None)
+    site.adopt(page)
+    if kind == "deep":
+        parent = page
+        for i in xrange(size):
+            element = webdoc.DocHtmlElement(u"div", {}, "bench.xml", None)
+            parent.adopt(element)
+            parent = element
+        parent.adopt(webdoc.DocHtmlText(u"leaf"))
+    else:
+        parent = webdoc.DocHtmlElement(u"ul", {}, "bench.xml", None)
+        page.adopt(parent)
+        for i in xrange(size):
+            element = webdoc.DocHtmlElement(u"li", {u"class": u"item"},
+                                            "bench.xml", None)
+            parent.adopt(element)
+            element.adopt(webdoc.DocHtmlText(u"item"))
+    return page
+
+def renderPage(webdoc, page):
+    """
+    Publish the content of PAGE in memory. Returns the time taken and
+    the size of the page.
+    """
+    generator = webdoc.CaptureGenerator()
+    generator.open("bench.html")
+    start = time.time()
+    page.publish(generator, page)
+    generator.close()
+    return time.time() - start, len(generator.pages[0])
+
+# --------------------------------------------------------------------
+if __name__ == '__main__':
+# --------------------------------------------------------------------
+    (opts, args) = parser.parse_args()
+
+    webdoc = imp.load_source("webdoc", opts.webdoc)
+
+    print "%-6s %10s %10s %12s" % ("tree", "nodes", "time (s)", "bytes")
+    for kind, size in [("deep", opts.depth), ("wide", opts.width)]:
+        page = buildPage(webdoc, kind, size)
+        try:
+            elapsed, numBytes = renderPage(webdoc, page)
+        except RuntimeError, e:
+            print "%-6s %10d %s" % (kind, size, e)
+            continue
+        print "%-6s %10d %10.2f %12d" % (kind, size, elapsed, numBytes)
+        page = None
@@ -12,11 +12,27 @@
 import types
 import xml.sax
 import xml.sax.saxutils
+import xml.sax.xmlreader
+import xml.parsers.expat
 import re
 import os
 import sys
 import random
 import copy
+import multiprocessing
+import threading
+import Queue
+import time
+import tarfile
+import zipfile
+import gzip
+import BaseHTTPServer
+import mimetypes
+import urllib
+import cStringIO
+import cPickle
+import hashlib
+import json
 import htmlentitydefs
 
 from xml.sax.handler import ContentHandler
@@ -36,8 +52,24 @@ except ImportError:
 
 usage = """webdoc [OPTIONS...] <DOC.XML>
 
---outdir   Set output directory
---verbose  Be verbose
+--outdir       Set output directory
+--verbose      Be verbose
+--incremental  Re-render only the pages whose inputs changed
+--jobs         Number of processes rendering pages
+--writers      Number of threads writing the pages in the background
+--changes      Write the list of the output files changed to this file
+--archive      Write the pages into a .zip or .tar[.gz|.bz2] archive (- for stdout)
+--gzip         Also write a .gz copy of each page, at this compression level
+--watch        Rebuild the site when one of its files changes
+--serve        Serve the pages on localhost at this port while watching
+--affected     Print the pages affected by a change to this file, and exit
+--cachedir     Keep cached data (parsed files, highlighted code) in this directory
+--cachesize    Maximum size of the cache, in MB
+--compact-dtd  Use built-in tables instead of reading the XHTML DTD files
+--parser       XML parser (sax or expat)
+--memory-report  Print the memory used by the document nodes, and an
+                 estimate of the memory they used with instance
+                 dictionaries
 """
 
 parser = OptionParser(usage=usage)
@@ -56,6 +88,129 @@ parser.add_option(
     action  = "store",
     help    = "write output to this directory")
 
+parser.add_option(
+    "-i", "--incremental",
+    dest    = "incremental",
+    default = False,
+    action  = "store_true",
+    help    = "re-render only the pages whose inputs changed since the last "
+              "build, as recorded in the build manifest; the manifest, also "
+              "used to delete the pages removed from the document, is kept "
+              "only with --incremental, --changes, --watch or --cachedir, "
+              "in the --cachedir directory if given and otherwise in the "
+              "output directory as .webdoc-manifest.json (do not publish it)")
+
+parser.add_option(
+    "-j", "--jobs",
+    dest    = "jobs",
+    default = 1,
+    action  = "store",
+    type    = "int",
+    help    = "render pages using this number of processes")
+
+parser.add_option(
+    "--writers",
+    dest    = "writers",
+    default = 0,
+    action  = "store",
+    type    = "int",
+    help    = "write the pages using this number of background threads "
+              "(0 to write them as soon as they are rendered)")
+
+parser.add_option(
+    "--changes",
+    dest    = "changes",
+    default = None,
+    action  = "store",
+    help    = "write the output files added, modified and deleted by the "
+              "build to this file, as JSON lines; the build manifest is then "
+              "kept (see --incremental), but never listed")
+
+parser.add_option(
+    "--archive",
+    dest    = "archive",
+    default = None,
+    action  = "store",
+    help    = "write the pages into this .zip, .tar, .tar.gz or .tar.bz2 "
+              "archive instead of the output directory (- to write a tar "
+              "stream to the standard output); cannot be used with "
+              "--incremental, --gzip or --watch")
+
+parser.add_option(
+    "--gzip",
+    dest    = "gzip",
+    default = 0,
+    action  = "store",
+    type    = "int",
+    help    = "also write a copy of each page compressed at this level "
+              "(1 to 9, 0 for none) with the .gz suffix")
+
+parser.add_option(
+    "--watch",
+    dest    = "watch",
+    default = False,
+    action  = "store_true",
+    help    = "keep running and rebuild the pages affected by a change "
+              "to the input files")
+
+parser.add_option(
+    "--serve",
+    dest    = "serve",
+    default = None,
+    action  = "store",
+    type    = "int",
+    help    = "with --watch, serve the pages at http://localhost:PORT/")
+
+parser.add_option(
+    "--affected",
+    dest    = "affected",
+    default = [],
+    action  = "append",
+    metavar = "FILE",
+    help    = "print the output files of the pages whose content or template "
+              "comes from FILE (can be repeated), without publishing")
+
+parser.add_option(
+    "--cachedir",
+    dest    = "cachedir",
+    default = None,
+    action  = "store",
+    help    = "keep cached data and the build manifest across builds in "
+              "this directory")
+
+parser.add_option(
+    "--cachesize",
+    dest    = "cachesize",
+    default = 256,
+    action  = "store",
+    type    = "int",
+    help    = "limit the size of the cache to this number of MB")
+
+parser.add_option(
+    "--compact-dtd",
+    dest    = "compactdtd",
+    default = False,
+    action  = "store_true",
+    help    = "do not read the XHTML DTD files, but only the entity and attribute "
+              "declarations extracted from them")
+
+parser.add_option(
+    "--parser",
+    dest    = "parser",
+    default = "sax",
+    type    = "choice",
+    choices = ["sax", "expat"],
+    help    = "XML parser used to read the input files (sax or expat)")
+
+parser.add_option(
+    "--memory-report",
+    dest    = "memoryreport",
+    default = False,
+    action  = "store_true",
+    help    = "print the memory used by the document nodes, by node type, "
+              "next to an estimate of the memory used by the same nodes "
+              "with the former dictionary-based layout")
+
 DOCTYPE_XHTML_TRANSITIONAL = \
     '<!DOCTYPE html PUBLIC ' \
     '"-//W3C//DTD XHTML 1.0 Transitional//EN" ' \
@@ -68,22 +223,240 @@ for k, v in htmlentitydefs.name2codepoint.items():
     if c == u'&' or c == u'<' or c == u'>': continue
     mapUnicodeToHtmlEntity [c] = "&%s;"  % k
 
+# The same map, plus the XML markup characters, as a translation table
+# for unicode.translate(); see escapeXMLString()
+mapOrdinalToXMLEntity = { }
+for c, e in mapUnicodeToHtmlEntity.items():
+    mapOrdinalToXMLEntity [ord(c)] = unicode(e)
+mapOrdinalToXMLEntity [ord(u'&')] = u"&amp;"
+mapOrdinalToXMLEntity [ord(u'<')] = u"&lt;"
+mapOrdinalToXMLEntity [ord(u'>')] = u"&gt;"
+
+nonASCIIRegexp = re.compile(u'[^\x00-\x7f]')
+
+def escapeXMLString(text):
+    """
+    Escape TEXT for inclusion in a XML document. The result is the
+    same as xml.sax.saxutils.escape(TEXT, mapUnicodeToHtmlEntity),
+    but obtained in a single pass over the string.
+    """
+    if isinstance(text, str): text = unicode(text)
+    if nonASCIIRegexp.search(text) is None:
+        # fast path: only the ASCII characters &<>" may need escaping
+        return text.replace(u"&", u"&amp;").replace(u">", u"&gt;") \
+            .replace(u"<", u"&lt;").replace(u'"', u"&quot;")
+    return text.translate(mapOrdinalToXMLEntity)
+
 # This indexes the document nodes by ID
 nodeIndex = { }
 
+# This indexes the document nodes by class (including the base
+# classes), in post-order. It is filled by DocHandler as the elements
+# are closed, so the last DocNode is the root of the document.
+nodeTypeIndex = { }
+
+def indexNodeType(node):
+    """
+    Add NODE to the node type index.
+    """
+    for nodeType in node.__class__.__mro__:
+        if nodeType is DocBareNode: break
+        if nodeType in nodeTypeIndex:
+            nodeTypeIndex[nodeType].append(node)
+        else:
+            nodeTypeIndex[nodeType] = [node]
+
+def replaceIndexedNodes(oldNodes, newNodes):
+    """
+    Replace in the node type index the DocNodes OLDNODES of a subtree
+    by the DocNodes NEWNODES, which have just been indexed (so they
+    are at the end of the lists). Both are in post-order. Returns
+    False if the position of a new node in the index cannot be found
+    (the index must then be rebuilt with rebuildNodeTypeIndex()).
+    """
+    oldByType = {}
+    for node in oldNodes:
+        for nodeType in node.__class__.__mro__:
+            if nodeType is DocBareNode: break
+            oldByType.setdefault(nodeType, []).append(node)
+    newCounts = {}
+    for node in newNodes:
+        for nodeType in node.__class__.__mro__:
+            if nodeType is DocBareNode: break
+            newCounts[nodeType] = newCounts.get(nodeType, 0) + 1
+    for nodeType in set(oldByType) | set(newCounts):
+        indexedNodes = nodeTypeIndex.setdefault(nodeType, [])
+        count = newCounts.get(nodeType, 0)
+        added = indexedNodes[len(indexedNodes) - count:]
+        del indexedNodes[len(indexedNodes) - count:]
+        old = oldByType.get(nodeType)
+        if old is None:
+            # the subtree had no node of this type
+            indexedNodes.extend(added)
+            return False
+        # the old nodes are contiguous, as the subtree is
+        start = indexedNodes.index(old[0])
+        indexedNodes[start : start + len(old)] = added
+    return True
+
+def walkDocNodes(rootNode):
+    """
+    Returns the DocNodes of the tree rooted at ROOTNODE, in
+    post-order. Unlike walkNodes(), the node type index is not used,
+    so that it can be called while the index is being updated.
+    """
+    nodes = []
+    stack = [rootNode]
+    while len(stack) > 0:
+        node = stack.pop()
+        if isinstance(node, DocNode):
+            nodes.append(node)
+            stack.extend(node.children)
+    nodes.reverse()
+    return nodes
+
+def rebuildNodeTypeIndex(rootNode):
+    """
+    Index again the nodes of the tree rooted at ROOTNODE.
+    """
+    nodeTypeIndex.clear()
+    for node in walkDocNodes(rootNode):
+        indexNodeType(node)
+
+# Containers shared by the nodes without children or attributes;
+# they must never be modified
+emptyChildren = ()
+emptyAttributes = {}
+
+# Canonical copies of tag names, attribute names and file names
+internedStrings = {}
+
+def internString(string):
+    """
+    Return the canonical copy of STRING, so that all the nodes refer
+    to a single copy of each name.
+    """
+    return internedStrings.setdefault(string, string)
+
+# --------------------------------------------------------------------
+class NodeIDAllocator:
+# --------------------------------------------------------------------
+    """
+    Generates unique IDs for the document nodes. IDs are obtained by
+    appending a numeric suffix to a prefix ("id", "id-1", "id-2",
+    ...). A counter is kept for each prefix, so that allocating an ID
+    does not require rescanning the suffixes already in use. IDs
+    supplied by the user are still honoured by skipping over any
+    candidate that is already in the node index.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.counters = {}
+
+    def allocate(self, prefix = "id"):
+        """
+        Return an ID starting with PREFIX that is not in the index.
+        """
+        count = self.counters.get(prefix, 0)
+        if count == 0:
+            uniqueId = prefix
+        else:
+            uniqueId = "%s-%d" % (prefix, count)
+        while uniqueId in self.index:
+            count += 1
+            uniqueId = "%s-%d" % (prefix, count)
+        self.counters[prefix] = count
+        return uniqueId
+
+    def reset(self):
+        """
+        Forget the counters, e.g. after clearing the index.
+        """
+        self.counters = {}
+
+nodeIDAllocator = NodeIDAllocator(nodeIndex)
+
 def getUniqueNodeID(id = None):
     """
     getUniqueNodeID() generates an unique ID for a document node.
     getUniqueNodeID(id) generates an unique ID adding a suffix to id.
     """
     if id is None: id = "id"
-    uniqueId = id
-    count = 0
-    while 1:
-        if uniqueId not in nodeIndex: break
-        count += 1
-        uniqueId = "%s-%d" % (id, count)
-    return uniqueId
+    return nodeIDAllocator.allocate(id)
+
+# Environment variables read while publishing (name -> value or None)
+envReads = { }
+
+def readEnv(name):
+    """
+    Return the value of the environment variable NAME, or None if the
+    variable is not defined. The access is recorded in envReads, so
+    that incremental builds can detect a change of the environment.
+    """
+    value = os.environ.get(name)
+    envReads[name] = value
+    return value
+
+_codeFingerprint = None
+
+def getCodeFingerprint():
+    """
+    Return a digest identifying this version of webdoc (and of the
+    syntax highlighter, if any). Cached data produced by a different
+    version is discarded.
+    """
+    global _codeFingerprint
+    if _codeFingerprint is None:
+        sourcePath = __file__
+        if sourcePath.endswith(('.pyc', '.pyo')): sourcePath = sourcePath[:-1]
+        h = hashlib.sha1(open(sourcePath, 'rb').read())
+        if has_pygments: h.update(pygments.__version__)
+        _codeFingerprint = h.hexdigest()
+    return _codeFingerprint
+
+def pruneCache(cacheDir, maxSize):
+    """
+    Delete the least recently used files in the cache directory
+    CACHEDIR until its size is at most MAXSIZE bytes. Cache users
+    update the modification time of the files they read.
+    """
+    entries = []
+    cacheSize = 0
+    for dirPath, dirNames, fileNames in os.walk(cacheDir):
+        # the build manifests are not cached data
+        if dirPath == cacheDir and "manifest" in dirNames:
+            dirNames.remove("manifest")
+        for fileName in fileNames:
+            path = os.path.join(dirPath, fileName)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            cacheSize += st.st_size
+    entries.sort()
+    for mtime, size, path in entries:
+        if cacheSize <= maxSize: break
+        try:
+            os.remove(path)
+            cacheSize -= size
+        except OSError:
+            pass
+
+def writeCacheFile(path, data):
+    """
+    Write DATA to the cache file PATH. The data is written to a
+    temporary file which is then renamed, so that concurrent readers
+    never see a partial file.
+    """
+    ensureDir(os.path.dirname(path))
+    tmpPath = "%s.%d.tmp" % (path, os.getpid())
+    f = open(tmpPath, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmpPath, path)
 
 def dumpIndex():
     """
@@ -92,6 +465,102 @@ def dumpIndex():
     for x in nodeIndex.itervalues():
       print x
 
+def getNodeSize(node, seen):
+    """
+    Return the size in bytes of NODE and of the objects it owns
+    (attributes, children list, text, location), not counting the
+    objects whose id is in the set SEEN, which is updated.
+    """
+    objs = [node]
+    for name in ("__dict__", "children", "attrs", "id", "text",
+                 "sourceURL", "sourceRow", "sourceColumn"):
+        obj = getattr(node, name, None)
+        if obj is not None: objs.append(obj)
+    attrs = getattr(node, "attrs", None)
+    if attrs: objs.extend(attrs.keys() + attrs.values())
+    size = 0
+    for obj in objs:
+        if id(obj) in seen: continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+    return size
+
+class DictLayoutNode:
+    """
+    An old-style class, whose instances keep their fields in a
+    dictionary (see estimateDictNodeSize()).
+    """
+    pass
+
+def estimateDictNodeSize(node):
+    """
+    Estimate the size in bytes that NODE would use with the layout
+    of the nodes before they had slots: an instance keeping its
+    fields (and a parent, for the text nodes) in a dictionary, with a
+    children list and an attribute dictionary of its own even if
+    empty, its own copies of the tag and attribute names, and its own
+    copy of the text, as the whitespace was not shared.
+    """
+    fields = {}
+    for nodeType in node.__class__.__mro__:
+        for name in getattr(nodeType, "__slots__", ()):
+            fields[name] = None
+    if not isinstance(node, DocNode): fields["parent"] = None
+    size = sys.getsizeof(DictLayoutNode()) + sys.getsizeof(fields)
+    if isinstance(node, DocNode):
+        size += sys.getsizeof(list(node.children))
+        size += sys.getsizeof(dict(node.attrs))
+        for name, value in node.attrs.iteritems():
+            size += sys.getsizeof(name) + sys.getsizeof(value)
+        size += sys.getsizeof(node.id)
+    tag = getattr(node, "tag", None)
+    if tag is not None: size += sys.getsizeof(tag)
+    text = getattr(node, "text", None)
+    if text is not None: size += sys.getsizeof(text)
+    return size
+
+def reportMemory(rootNode):
+    """
+    Print the number of nodes and the memory they use, by node type.
+    Objects shared by several nodes are counted once. The memory that
+    the same nodes would use with the layout based on instance
+    dictionaries is estimated for comparison (see
+    estimateDictNodeSize()); as the shared text nodes are then counted
+    once per occurrence, so are the nodes.
+    """
+    counts = {}
+    sizes = {}
+    dictCounts = {}
+    dictSizes = {}
+    seen = set()
+    stack = [rootNode]
+    while len(stack) > 0:
+        node = stack.pop()
+        typeName = node.__class__.__name__
+        dictCounts[typeName] = dictCounts.get(typeName, 0) + 1
+        dictSizes[typeName] = dictSizes.get(typeName, 0) + \
+            estimateDictNodeSize(node)
+        stack.extend(node.getChildren())
+        if id(node) in seen: continue
+        counts[typeName] = counts.get(typeName, 0) + 1
+        sizes[typeName] = sizes.get(typeName, 0) + getNodeSize(node, seen)
+    print "%-16s %10s %12s %10s   %-23s" % (
+        "", "", "", "", "dictionary layout (est.)")
+    print "%-16s %10s %12s %10s %10s %12s" % (
+        "node type", "nodes", "bytes", "bytes/node", "nodes", "bytes")
+    for typeName in sorted(dictCounts.keys()):
+        print "%-16s %10d %12d %10.1f %10d %12d" % (
+            typeName, counts[typeName], sizes[typeName],
+            float(sizes[typeName]) / counts[typeName],
+            dictCounts[typeName], dictSizes[typeName])
+    numNodes = sum(counts.values())
+    totalSize = sum(sizes.values())
+    print "%-16s %10d %12d %10.1f %10d %12d" % (
+        "total", numNodes, totalSize, float(totalSize) / numNodes,
+        sum(dictCounts.values()), sum(dictSizes.values()))
+    print "%-16s %10d %12d" % ("node index", len(nodeIndex),
+                               sys.getsizeof(nodeIndex))
+
 def ensureDir(dirName):
     """
     Create the directory DIRNAME if it does not exsits.
@@ -148,19 +617,34 @@ def calcRelURL(toURL, fromURL):
     return urlunparse(("", "", relPath, "", "", toURL.fragment))
 
 def walkNodes(rootNode, nodeType = None):
-    for n in rootNode.getChildren():
-        for m in walkNodes(n, nodeType):
-            yield m
-    if not nodeType or rootNode.isA(nodeType):
-        yield rootNode
+    """
+    Returns the nodes of type NODETYPE (all the nodes if NODETYPE is
+    None) of the tree rooted at ROOTNODE, in post-order.
+    """
+    indexedNodes = nodeTypeIndex.get(DocNode)
+    if nodeType is not None and issubclass(nodeType, DocNode) and \
+            indexedNodes and indexedNodes[-1] is rootNode:
+        # ROOTNODE is the root of the indexed tree
+        return list(nodeTypeIndex.get(nodeType, emptyChildren))
+    nodes = []
+    stack = [rootNode]
+    while len(stack) > 0:
+        node = stack.pop()
+        if not nodeType or node.isA(nodeType):
+            nodes.append(node)
+        stack.extend(node.getChildren())
+    nodes.reverse()
+    return nodes
 
 def walkAncestors(leafNode, nodeType = None):
+    """
+    Yields LEAFNODE and its ancestors of type NODETYPE (all the
+    ancestors if NODETYPE is None), from the nearest.
+    """
     if not nodeType or leafNode.isA(nodeType):
         yield leafNode
-    p = leafNode.getParent()
-    if p:
-        for m in walkAncestors(p, nodeType):
-            yield m
+    for node in leafNode.findAncestors(nodeType):
+        yield node
 
 # --------------------------------------------------------------------
 class DocLocation:
@@ -217,18 +701,21 @@ class makeGuard(object):
             self.func(obj, *args, **keys)
         except DocError, e:
             e.appendLocation(obj.getLocation())
+            raise
 
     def __get__(self, obj, type=None):
         return types.MethodType(self, obj, type)
 
 # --------------------------------------------------------------------
-class DocBareNode:
+class DocBareNode(object):
 # --------------------------------------------------------------------
     """
     A node of the document tree without parent, children, or any
     other attribute. It is used to implement common leaf nodes such
     as text chunks.
     """
+    __slots__ = ()
+
     def __init__(self): pass
 
     def isA(self, classInfo):
@@ -239,16 +726,28 @@ class DocBareNode:
 
     def getChildren(self):
         """
-        Returs an empty list
+        Returs an empty sequence.
         """
-        return []
+        return emptyChildren
+
+    # TRUE if the node appends its location to the DocErrors raised
+    # while publishing it
+    guarded = False
 
     def setParent(self, parent): pass
     def getPublishDirName(self): pass
     def getPublishFileName(self): pass
     def getPublishURL(self): pass
     def publish(self, generator, pageNode = None): pass
-    def publishIndex(self, gen, pageNode, openNodeStack): return False
+
+    def expand(self, generator, pageNode, stack):
+        """
+        Publish the node on behalf of publishNodes(). Nodes with
+        children may instead publish only their opening markup, and
+        push on STACK their children in reverse order, preceded by
+        a tuple (CLOSINGMARKUP, GUARDEDNODE) (see publishNodes()).
+        """
+        self.publish(generator, pageNode)
 
 # --------------------------------------------------------------------
 class DocNode(DocBareNode):
@@ -258,9 +757,17 @@ class DocNode(DocBareNode):
     additional meta-information such as the location
     of the XML element that caused this node to be generated.
     """
+    __slots__ = ("parent", "children", "attrs", "id",
+                 "sourceURL", "sourceRow", "sourceColumn",
+                 "depth", "parentPage", "parentSite", "publishDirName")
+
     def __init__(self, attrs, URL, locator):
         self.parent = None
-        self.children = []
+        self.children = emptyChildren
+        self.depth = 0
+        self.parentPage = None
+        self.parentSite = None
+        self.publishDirName = None
         self.attrs = attrs
         self.sourceURL = None
         self.sourceRow = None
@@ -310,44 +817,81 @@ class DocNode(DocBareNode):
         """
         return self.attrs
 
+    def getParentPage(self):
+        """
+        Return the nearest ancestor of type DocPage, or None.
+        """
+        return self.parentPage
+
+    def getParentSite(self):
+        """
+        Return the nearest ancestor of type DocSite, or None.
+        """
+        return self.parentSite
+
     def getDepth(self):
         """
         Return the depth of the node in the tree.
         """
-        if self.parent:
-            return self.parent.getDepth() + 1
-        else:
-            return 0
+        return self.depth
 
     def setParent(self, parent):
         """
-        Set the parent of the node.
+        Set the parent of the node, and derive from it the depth, the
+        nearest ancestor page and site, and the publish directory of
+        the node.
         """
         self.parent = parent
+        self.depth = parent.depth + 1
+        if parent.isA(DocPage): self.parentPage = parent
+        else:                   self.parentPage = parent.parentPage
+        if parent.isA(DocSite): self.parentSite = parent
+        else:                   self.parentSite = parent.parentSite
+        self.publishDirName = parent.getPublishDirName()
 
     def adopt(self, orfan):
         """
         Adds ORFAN to the node children and make the node the parent
         of ORFAN. ORFAN can also be a sequence of orfans.
         """
-        self.children.append(orfan)
+        if self.children:
+            self.children.append(orfan)
+        else:
+            self.children = [orfan]
         orfan.setParent(self)
+        if orfan.getChildren():
+            # a subtree is adopted at once: update its descendants
+            stack = [orfan]
+            while len(stack) > 0:
+                node = stack.pop()
+                for child in node.getChildren():
+                    child.setParent(node)
+                    stack.append(child)
 
     def findAncestors(self, nodeType = None):
         """
         Return the node ancestors of type NODETYPE. If NODETYPE is
         None, returns all ancestors.
         """
-        if nodeType is None:
-            nodeType = DocNode
-        if self.parent:
-            if self.parent.isA(nodeType):
-                found = [self.parent]
-            else:
-                found = []
-            found = found + self.parent.findAncestors(nodeType)
-            return found
-        return []
+        found = []
+        if nodeType is DocPage:
+            node = self.parentPage
+            while node:
+                found.append(node)
+                node = node.parentPage
+        elif nodeType is DocSite:
+            node = self.parentSite
+            while node:
+                found.append(node)
+                node = node.parentSite
+        else:
+            if nodeType is None:
+                nodeType = DocNode
+            node = self.parent
+            while node:
+                if node.isA(nodeType): found.append(node)
+                node = node.parent
+        return found
 
     def findChildren(self, nodeType = None):
         """
@@ -366,20 +910,21 @@ class DocNode(DocBareNode):
         location = DocLocation(self.sourceURL,
                                self.sourceRow,
                                self.sourceColumn)
-        if self.parent:
-            parentLocation = self.parent.getLocation()
-            if location.URL is None: location.URL = parentLocation.URL
-            if location.row is None: location.URL = parentLocation.row
-            if location.column is None: location.URL = parentLocation.column
+        # the missing parts are taken from the nearest ancestor
+        node = self.parent
+        while node and (location.URL is None or location.row is None or
+                        location.column is None):
+            if location.URL is None: location.URL = node.sourceURL
+            if location.row is None: location.row = node.sourceRow
+            if location.column is None: location.column = node.sourceColumn
+            node = node.parent
         return location
 
     def getPublishDirName(self):
         """
         Returns the publish dir name of the parent.
         """
-        if self.parent:
-            return self.parent.getPublishDirName()
-        return None
+        return self.publishDirName
 
     def getPublishFileName(self):
         """
@@ -395,109 +940,466 @@ class DocNode(DocBareNode):
 
     def publish(self, generator, pageNode = None):
         """
-        Recursively calls PUBLISH() on its children.
+        Publishes its children.
         """
-        for c in self.getChildren():
-            c.publish(generator, pageNode)
+        publishNodes(generator, pageNode, self.getChildren())
         return None
 
-    def publishIndex(self, gen, pageNode, openNodeStack):
-        """
-        Recursively calls PUBLISHINDEX() on its children.
-        """
-        hasIndexedChildren = False
-        for c in self.getChildren():
-            hasIndexedChildren = c.publishIndex(gen, pageNode, openNodeStack) \
-                or hasIndexedChildren
-        return hasIndexedChildren
+# --------------------------------------------------------------------
+def publishNodes(gen, pageNode, nodes):
+# --------------------------------------------------------------------
+    """
+    Publish the sequence of NODES for the page PAGENODE (None when
+    publishing the site structure). The subtrees are walked with an
+    explicit stack rather than by recursion, so that their depth is
+    not limited: the stack holds the nodes to publish (see
+    DocBareNode.expand()) and tuples (CLOSINGMARKUP, GUARDEDNODE),
+    which output CLOSINGMARKUP (if not None) once the children of
+    GUARDEDNODE are published. While GUARDEDNODE (if not None) is on
+    the stack, its location is appended to the DocErrors raised, as
+    makeGuard does.
+    """
+    stack = list(nodes)
+    stack.reverse()
+    item = None
+    try:
+        while len(stack) > 0:
+            item = stack.pop()
+            if item.__class__ is tuple:
+                if item[0] is not None: gen.putString(item[0])
+            else:
+                item.expand(gen, pageNode, stack)
+    except DocError, e:
+        if item.__class__ is tuple: stack.append(item)
+        for i in xrange(len(stack) - 1, -1, -1):
+            if stack[i].__class__ is tuple and stack[i][1] is not None:
+                e.appendLocation(stack[i][1].getLocation())
+        raise
 
 # --------------------------------------------------------------------
-def expandAttr(value, pageNode):
+def publishDirective(gen, pageNode, directive, argument):
 # --------------------------------------------------------------------
     """
-    Expand an attribute by substituting any directive with its value.
+    Publish the value of the directive %DIRECTIVE[:ARGUMENT]; found in
+    a text node, as seen from the page PAGENODE. ARGUMENT includes the
+    leading colon.
+    """
+    if directive == "content":
+        pageNode.publish(gen, pageNode)
+
+    elif directive == "pagestyle":
+        for s in pageNode.findChildren(DocPageStyle):
+            s.publish(gen, pageNode)
+
+    elif directive == "pagescript":
+        for s in pageNode.findChildren(DocPageScript):
+            s.publish(gen, pageNode)
+
+    elif directive == "pagetitle":
+        gen.putString(pageNode.title)
+
+    elif directive == "path":
+        ancPages = [x for x in walkAncestors(pageNode, DocPage)]
+        ancPages.reverse()
+        gen.putString(" - ".join([x.title for x in ancPages]))
+
+    elif directive == "navigation":
+        gen.putString("<ul>\n")
+        siteNode = pageNode.getParentSite()
+        siteNode.getNavigation().publish(gen, pageNode)
+        gen.putString("</ul>\n")
+
+    elif directive == "env":
+        envName = argument[1:]
+        envValue = readEnv(envName)
+        if envValue is not None:
+            gen.putString(envValue)
+        else:
+            print "warning: environment variable '%s' not defined" % envName
+    else:
+        print "warning: ignoring unknown directive '%s'" % directive
+
+# Directives in text nodes and in attribute values
+textDirectiveRegexp = re.compile("%(\w+)(:[^;]*)?;")
+attrDirectiveRegexp = re.compile("%[-\w._#:]+;")
+pathtoDirectiveRegexp = re.compile("%pathto:([-\w._#:]+);")
+
+# The directives that publishDirective() understands
+textDirectives = frozenset(["content", "pagestyle", "pagescript",
+                            "pagetitle", "path", "navigation", "env"])
+
+def tokenizeText(text):
+    """
+    Split the content TEXT of a text node into a tuple of literal
+    strings and (DIRECTIVE, ARGUMENT) pairs, one for each
+    %directive[:argument]; (ARGUMENT includes the leading colon, or
+    is None). Returns None if TEXT contains no directive.
+    """
+    if text.find("%") < 0: return None
+    tokens = []
+    next = 0
+    for m in textDirectiveRegexp.finditer(text):
+        if next < m.start():
+            tokens.append(text[next : m.start()])
+        next = m.end()
+        tokens.append((m.group(1), m.group(2)))
+    if next == 0: return None
+    if next < len(text): tokens.append(text[next:])
+    return tuple(tokens)
+
+def tokenizeChunks(chunks):
+    """
+    Tokenize (see tokenizeText()) the text made of the strings CHUNKS,
+    as delivered by the parser. Each chunk is split on its own, so
+    that a directive is never formed across a character or entity
+    reference (e.g. &#37;pagetitle; is the literal text %pagetitle;).
+    Adjacent literal strings are merged. Returns None if the text
+    contains no directive.
+    """
+    tokens = []
+    hasDirectives = False
+    for chunk in chunks:
+        chunkTokens = tokenizeText(chunk)
+        if chunkTokens is None:
+            if len(chunk) == 0: continue
+            chunkTokens = (chunk,)
+        else:
+            hasDirectives = True
+        for token in chunkTokens:
+            if token.__class__ is not tuple and len(tokens) > 0 and \
+                    tokens[-1].__class__ is not tuple:
+                tokens[-1] = tokens[-1] + token
+            else:
+                tokens.append(token)
+    if not hasDirectives: return None
+    return tuple(tokens)
+
+def tokenizeAttr(value):
     """
-    xvalue = ""
+    Split the attribute VALUE into a tuple of literal strings and
+    (DIRECTIVE, ARGUMENT) pairs, where DIRECTIVE is "pathto", "env",
+    or None for an unknown directive (ARGUMENT is then the whole
+    directive). Returns None if VALUE contains no directive.
+    """
+    if value.find("%") < 0: return None
+    tokens = []
     next = 0
-    for m in re.finditer("%[-\w._#:]+;", value):
+    for m in attrDirectiveRegexp.finditer(value):
         if next < m.start():
-            xvalue += value[next : m.start()]
+            tokens.append(value[next : m.start()])
         next = m.end()
         directive = value[m.start()+1 : m.end()-1]
-        mo = re.match('pathto:(.*)', directive)
-        if mo:
-            toNodeID = mo.group(1)
-            toNodeURL = None
-            if nodeIndex.has_key(toNodeID):
-                toNodeURL = nodeIndex[toNodeID].getPublishURL()
-            if toNodeURL is None:
-                print "warning: could not cross-reference '%s'" % toNodeID
-                toNodeURL = toNodeID
+        if directive.startswith("pathto:"):
+            tokens.append(("pathto", directive[7:]))
+        elif directive.startswith("env:"):
+            tokens.append(("env", directive[4:]))
+        else:
+            tokens.append((None, directive))
+    if next == 0: return None
+    if next < len(value): tokens.append(value[next:])
+    return tuple(tokens)
+
+# --------------------------------------------------------------------
+class CrossReferences:
+# --------------------------------------------------------------------
+    """
+    Resolves the %pathto:ID; directives. The publish URL of each
+    target is computed once, and the relative URL of a target is
+    memoized for each directory it is referenced from (the relative
+    URL does not depend on the file name of the referencing page).
+
+    resolve() is run after parsing: it collects the targets
+    referenced by the attributes of the document, and reports the
+    unresolved ones in a single warning.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the resolved URLs, e.g. after reloading the document.
+        """
+        self.targetURLs = {}
+        self.relativeURLs = {}
+        self.pageDirURLs = {}
+
+    def resolve(self, rootNode):
+        """
+        Compute the publish URLs of the targets referenced by the
+        nodes of the tree rooted at ROOTNODE, and print a warning
+        listing the targets that do not exist.
+        """
+        unresolved = {}
+        for node in walkNodes(rootNode, DocNode):
+            if node.attrs is emptyAttributes: continue
+            for value in node.attrs.itervalues():
+                if value.find("%pathto:") < 0: continue
+                for m in pathtoDirectiveRegexp.finditer(value):
+                    toNodeID = m.group(1)
+                    if self.getTargetURL(toNodeID, False) is None:
+                        unresolved.setdefault(toNodeID, []).append(node)
+        if len(unresolved) == 0: return
+        print "warning: could not cross-reference %d target(s):" % \
+            len(unresolved)
+        for toNodeID in sorted(unresolved):
+            nodes = unresolved[toNodeID]
+            print "  '%s' referenced %d time(s), first at %s" % \
+                (toNodeID, len(nodes), nodes[0].getLocation())
+
+    def getTargetURL(self, toNodeID, warn = True):
+        """
+        Returns the publish URL of the node TONODEID, or None if the
+        node does not exist or is not published. If WARN is true, a
+        warning is printed the first time that TONODEID is not found.
+        """
+        if toNodeID in self.targetURLs:
+            return self.targetURLs[toNodeID]
+        toNodeURL = None
+        if nodeIndex.has_key(toNodeID):
+            toNodeURL = nodeIndex[toNodeID].getPublishURL()
+        if toNodeURL is None and warn:
+            print "warning: could not cross-reference '%s'" % toNodeID
+        self.targetURLs[toNodeID] = toNodeURL
+        return toNodeURL
+
+    def getRelativeURL(self, toNodeID, pageNode):
+        """
+        Returns the URL of the node TONODEID relative to the page
+        PAGENODE. The URL of an unresolved target is the ID itself.
+        """
+        fromDirURL = self.pageDirURLs.get(pageNode)
+        if fromDirURL is None:
             fromPageURL = pageNode.getPublishURL()
-            xvalue += calcRelURL(toNodeURL, fromPageURL)
+            fromDirURL = fromPageURL[:fromPageURL.rfind("/") + 1]
+            self.pageDirURLs[pageNode] = fromDirURL
+        key = (fromDirURL, toNodeID)
+        relURL = self.relativeURLs.get(key)
+        if relURL is None:
+            toNodeURL = self.getTargetURL(toNodeID)
+            if toNodeURL is None: toNodeURL = toNodeID
+            relURL = calcRelURL(toNodeURL, fromDirURL)
+            self.relativeURLs[key] = relURL
+        return relURL
+
+crossReferences = CrossReferences()
+
+# --------------------------------------------------------------------
+def expandAttr(value, pageNode):
+# --------------------------------------------------------------------
+    """
+    Expand an attribute by substituting any directive with its value.
+    """
+    tokens = tokenizeAttr(value)
+    if tokens is None: return value
+    return expandAttrTokens(tokens, pageNode)
+
+def expandAttrTokens(tokens, pageNode):
+    """
+    Returns the value of an attribute split by tokenizeAttr() into
+    TOKENS, as seen from the page PAGENODE.
+    """
+    xvalue = []
+    for token in tokens:
+        if token.__class__ is not tuple:
+            xvalue.append(token)
             continue
-        mo = re.match('env:(.*)', directive)
-        if mo:
-            envName = mo.group(1)
-            if envName in os.environ:
-                xvalue += os.environ[envName]
+        directive, argument = token
+        if directive == "pathto":
+            xvalue.append(crossReferences.getRelativeURL(argument, pageNode))
+        elif directive == "env":
+            envValue = readEnv(argument)
+            if envValue is not None:
+                xvalue.append(envValue)
             else:
-                print "warning: the environment variable '%s' not defined" % envName
-            continue
-        raise DocError(
-            "unknown directive '%s' found while expanding an attribute" % directive)
-    if next < len(value): xvalue += value[next:]
-    #print "EXPAND: ", value, " -> ", xvalue
-    return xvalue
+                print "warning: the environment variable '%s' not defined" % argument
+        else:
+            raise DocError(
+                "unknown directive '%s' found while expanding an attribute" % argument)
+    return u"".join(xvalue)
 
 # --------------------------------------------------------------------
 class Generator:
 # --------------------------------------------------------------------
-    def __init__(self, rootDir):
-        ensureDir(rootDir)
+    """
+    Renders the pages and hands them to an output backend
+    (DirectoryOutput or ArchiveOutput). File and directory paths are
+    relative to the root of the output.
+    """
+    def __init__(self, rootDir, manifest = None, output = None):
+        if output is None:
+            output = DirectoryOutput(rootDir)
+        self.output = output
         self.fileStack = []
-        self.dirStack = [rootDir]
-        ensureDir(rootDir)
+        self.chunks = None
+        self.dirStack = [""]
+        self.manifest = manifest
+        self.numPagesRendered = 0
+        self.pendingPages = None
+        self.writer = None
+        self.lock = threading.Lock()
+        self.numWritten = 0
+        self.numUnchanged = 0
+        self.changes = None
         #print "CD ", rootDir
 
-    def open(self, filePath):
+    def deferPages(self):
+        """
+        Collect the pages to be rendered in PENDINGPAGES instead of
+        rendering them immediately.
+        """
+        self.pendingPages = []
+
+    def publishPage(self, pageNode):
+        """
+        Render PAGENODE, or add it to PENDINGPAGES if the rendering
+        is deferred.
+        """
+        if self.writer is not None and self.writer.hasFailed():
+            # the build fails anyway (see finish())
+            return
+        if self.pendingPages is not None:
+            self.pendingPages.append(pageNode)
+        else:
+            pageNode.render(self)
+        self.numPagesRendered += 1
+
+    def setWriter(self, writer):
+        """
+        Hand the finished pages to the PageWriter WRITER instead of
+        writing them immediately.
+        """
+        self.writer = writer
+
+    def finish(self, raiseErrors = True):
+        """
+        Wait until all the pages are written. If RAISEERRORS is TRUE,
+        raise the DocError of the first page that could not be written.
+        """
+        if self.writer is not None:
+            self.writer.close(raiseErrors)
+            self.writer = None
+        try:
+            self.output.close()
+        except EnvironmentError, e:
+            if raiseErrors: raise DocError(e.__str__())
+
+    def writeFile(self, filePath, data, pageNode = None):
+        """
+        Write the page DATA (a byte string) to the file FILEPATH, or
+        queue it for the writer threads. PAGENODE is the page, if any.
+        """
+        if self.writer is not None:
+            self.writer.write(filePath, data, pageNode)
+            return
+        try:
+            status = self.output.write(filePath, data)
+        except EnvironmentError, e:
+            raise DocError(e.__str__())
+        self.recordWrite(filePath, data, status)
+
+    def recordWrite(self, filePath, data, status):
+        """
+        Account for the page DATA written to FILEPATH, with STATUS as
+        returned by writePageFile(). This is also called by the writer
+        threads.
+        """
+        if self.changes is not None and status != "unchanged":
+            change = (filePath, status, hashlib.sha1(data).hexdigest())
+        else:
+            change = None
+        self.lock.acquire()
+        try:
+            if status == "unchanged": self.numUnchanged += 1
+            else:                     self.numWritten += 1
+            if change is not None: self.changes.append(change)
+        finally:
+            self.lock.release()
+
+    def recordChanges(self):
+        """
+        Keep the list of the files added or modified (see
+        saveChanges()).
+        """
+        self.changes = []
+        self.output.recordChanges()
+
+    def saveChanges(self, fileName, removedPaths):
+        """
+        Write to FILENAME the files added or modified (including the
+        compressed copies of the pages) and the files REMOVEDPATHS
+        (relative to the output directory) deleted by the build. Each
+        line is a JSON object with the path of the file relative to
+        the output directory, the change ("added", "modified",
+        "deleted"), and the SHA-1 of the new content.
+        """
+        entries = list(self.changes) + self.output.getChanges()
+        for path in removedPaths:
+            entries.append((path, "deleted", None))
+        entries.sort()
+        f = open(fileName, "w")
+        try:
+            for path, status, contentHash in entries:
+                f.write(json.dumps({"path"   : path.replace(os.sep, "/"),
+                                    "change" : status,
+                                    "sha1"   : contentHash},
+                                   sort_keys = True) + "\n")
+        finally:
+            f.close()
+
+    def open(self, filePath, pageNode = None):
+        """
+        Start the page FILEPATH (of the page PAGENODE). The page is
+        accumulated in memory as a list of encoded chunks, and written
+        at once by close().
+        """
         filePath = os.path.join(self.dirStack[-1], filePath)
-        fid = open(filePath, "w")
-        self.fileStack.append(fid)
-        fid.write(DOCTYPE_XHTML_TRANSITIONAL)
+        self.chunks = [DOCTYPE_XHTML_TRANSITIONAL]
+        self.fileStack.append((filePath, self.chunks, pageNode))
         #print "OPEN ", filePath
 
     def putString(self, str):
-        fid = self.fileStack[-1]
+        # the chunks are encoded one by one, so that an encoding error
+        # is raised while publishing the offending node
         try:
-            encoded = str.encode('latin-1')
-            fid.write(encoded)
-        except (UnicodeEncodeError, IOError), e:
+            self.chunks.append(str.encode('latin-1'))
+        except UnicodeEncodeError, e:
             raise DocError(e.__str__())
 
     def putXMLString(self, str):
-        fid = self.fileStack[-1]
-        xstr = xml.sax.saxutils.escape(str, mapUnicodeToHtmlEntity)
+        xstr = escapeXMLString(str)
         try:
-            fid.write(xstr.encode('latin-1'))
+            self.chunks.append(xstr.encode('latin-1'))
         except:
             print "OFFENDING", str, xstr
             print mapUnicodeToHtmlEntity[str]
             raise
 
     def putXMLAttr(self, str):
-        fid = self.fileStack[-1]
         xstr = xml.sax.saxutils.quoteattr(str)
-        fid.write(xstr.encode('latin-1'))
+        self.chunks.append(xstr.encode('latin-1'))
+
+    def putEncoded(self, data):
+        """
+        Write the string DATA, which is already encoded.
+        """
+        self.chunks.append(data)
 
     def close(self):
-        self.fileStack.pop().close()
+        """
+        Finish the current page and write it with a single call.
+        """
+        filePath, chunks, pageNode = self.fileStack.pop()
+        if len(self.fileStack) > 0:
+            self.chunks = self.fileStack[-1][1]
+        else:
+            self.chunks = None
+        self.writeFile(filePath, "".join(chunks), pageNode)
         #print "CLOSE"
 
     def changeDir(self, dirName):
         currentDir = self.dirStack[-1]
         newDir = os.path.join(currentDir, dirName)
-        ensureDir(newDir)
+        self.output.makeDir(newDir)
         self.dirStack.append(newDir)
         #print "CD ", newDir
 
@@ -505,30 +1407,580 @@ class Generator:
         self.dirStack.pop()
         #print "CD .."
 
-    def tell(self):
-        fid = self.fileStack[-1]
-        return fid.tell()
-
-    def seek(self, pos):
-        fid = self.fileStack[-1]
-        fid.seek(pos)
-
 # --------------------------------------------------------------------
-class DocInclude(DocNode):
+def writePageFile(filePath, data):
 # --------------------------------------------------------------------
-    def __init__(self, attrs, URL, locator):
-        DocNode.__init__(self, attrs, URL, locator)
-        if not attrs.has_key("src"):
-            raise DocError("include missing 'src' attribute")
-        self.filePath = attrs["src"]
+    """
+    Write DATA to the file FILEPATH, unless the file has already this
+    content, so that its modification time is kept. Returns "added",
+    "modified", or "unchanged".
+    """
+    if not os.path.exists(filePath):
+        status = "added"
+    else:
+        status = "modified"
+        try:
+            if os.path.getsize(filePath) == len(data):
+                fid = open(filePath, "rb")
+                try:
+                    if fid.read() == data: status = "unchanged"
+                finally:
+                    fid.close()
+        except EnvironmentError:
+            pass
+        if status == "unchanged": return status
+    fid = open(filePath, "w")
+    try:
+        fid.write(data)
+    finally:
+        fid.close()
+    return status
 
-    def __str__(self):
-        return DocNode.__str__(self) + ":<web:include src=%s>" \
-            % xml.sax.saxutils.quoteattr(self.filePath)
+def compressPage(data, level):
+    """
+    Returns DATA compressed in the gzip format at the compression
+    LEVEL. The header has no file name and a null time stamp, so that
+    the same page always gives the same bytes.
+    """
+    buf = cStringIO.StringIO()
+    fid = gzip.GzipFile("", "wb", level, buf, 0)
+    try:
+        fid.write(data)
+    finally:
+        fid.close()
+    return buf.getvalue()
 
 # --------------------------------------------------------------------
-class DocDir(DocNode):
+class DirectoryOutput:
 # --------------------------------------------------------------------
+    """
+    Writes the pages as files in the directory ROOTDIR. If GZIPLEVEL
+    is not 0, a copy of each page compressed at this level is written
+    next to it, with the .gz suffix (for servers such as nginx with
+    gzip_static). The copy is compressed from the page in memory, and
+    only when the page has changed.
+
+    If PAGES is not None, the pages written are also stored in this
+    dictionary, by path (see PreviewServer).
+    """
+    def __init__(self, rootDir, gzipLevel = 0, pages = None):
+        self.rootDir = rootDir
+        self.gzipLevel = gzipLevel
+        self.pages = pages
+        self.changes = None
+        self.lock = threading.Lock()
+        ensureDir(rootDir)
+
+    def makeDir(self, dirPath):
+        ensureDir(os.path.join(self.rootDir, dirPath))
+
+    def write(self, filePath, data):
+        """
+        Write the page DATA to FILEPATH. Returns the status of
+        writePageFile() for the page.
+        """
+        if self.pages is not None:
+            self.pages[filePath] = data
+        gzipPath = filePath + ".gz"
+        fullPath = os.path.join(self.rootDir, filePath)
+        fullGzipPath = fullPath + ".gz"
+        status = writePageFile(fullPath, data)
+        if self.gzipLevel:
+            if status != "unchanged" or not os.path.isfile(fullGzipPath):
+                gzipData = compressPage(data, self.gzipLevel)
+                gzipStatus = writePageFile(fullGzipPath, gzipData)
+                if gzipStatus != "unchanged":
+                    self.recordChange(gzipPath, gzipStatus,
+                                      hashlib.sha1(gzipData).hexdigest())
+        elif status != "unchanged" and os.path.exists(fullGzipPath):
+            # Do not let the server send an out of date copy
+            os.remove(fullGzipPath)
+            self.recordChange(gzipPath, "deleted", None)
+        return status
+
+    def recordChanges(self):
+        """
+        Keep the list of the compressed copies added, modified or
+        deleted (see getChanges()).
+        """
+        self.changes = []
+
+    def recordChange(self, filePath, status, contentHash):
+        if self.changes is None: return
+        self.lock.acquire()
+        try:
+            self.changes.append((filePath, status, contentHash))
+        finally:
+            self.lock.release()
+
+    def getChanges(self):
+        """
+        Returns the changes made to the output files other than the
+        pages, as (path, status, SHA-1) tuples.
+        """
+        return list(self.changes or [])
+
+    def close(self): pass
+
+def getArchiveFormat(fileName):
+    """
+    Returns the format of the archive FILENAME ("zip", "tar", "tar.gz"
+    or "tar.bz2"), or None if its extension is unknown. "-" is a tar
+    stream.
+    """
+    if fileName == "-":               return "tar"
+    if fileName.endswith(".zip"):     return "zip"
+    if fileName.endswith(".tar.gz"):  return "tar.gz"
+    if fileName.endswith(".tgz"):     return "tar.gz"
+    if fileName.endswith(".tar.bz2"): return "tar.bz2"
+    if fileName.endswith(".tar"):     return "tar"
+    return None
+
+# --------------------------------------------------------------------
+class ArchiveOutput:
+# --------------------------------------------------------------------
+    """
+    Writes the pages into a single archive instead of a directory
+    tree. The format is chosen from the extension of FILENAME: .zip,
+    .tar, .tar.gz (or .tgz), or .tar.bz2. If FILENAME is "-", a tar
+    stream is written to the file object STREAM (e.g. the standard
+    output).
+    """
+    def __init__(self, fileName, stream = None):
+        self.zip = None
+        self.tar = None
+        self.mtime = time.time()
+        format = getArchiveFormat(fileName)
+        if format is None:
+            raise DocError("unknown archive format for '%s' "
+                           "(use .zip, .tar, .tar.gz, .tar.bz2, or -)" % fileName)
+        if fileName == "-":
+            self.tar = tarfile.open(fileobj = stream, mode = "w|")
+        elif format == "zip":
+            self.zip = zipfile.ZipFile(fileName, "w", zipfile.ZIP_DEFLATED)
+        else:
+            self.tar = tarfile.open(fileName, {"tar"     : "w",
+                                               "tar.gz"  : "w:gz",
+                                               "tar.bz2" : "w:bz2"}[format])
+
+    def makeDir(self, dirPath): pass
+
+    def write(self, filePath, data):
+        """
+        Add the page DATA to the archive as FILEPATH. Returns "added".
+        """
+        name = filePath.replace(os.sep, "/")
+        if self.zip is not None:
+            info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0644 << 16
+            self.zip.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = self.mtime
+            info.mode = 0644
+            self.tar.addfile(info, cStringIO.StringIO(data))
+        return "added"
+
+    def recordChanges(self): pass
+
+    def getChanges(self): return []
+
+    def close(self):
+        if self.zip is not None: self.zip.close()
+        if self.tar is not None: self.tar.close()
+
+# --------------------------------------------------------------------
+class MemoryOutput:
+# --------------------------------------------------------------------
+    """
+    Keeps the pages in the list PAGES instead of writing them. It is
+    used by CaptureGenerator: no directory is created.
+    """
+    def __init__(self):
+        self.pages = []
+
+    def makeDir(self, dirPath): pass
+
+    def write(self, filePath, data):
+        """
+        Append the page DATA to PAGES. Returns "added".
+        """
+        self.pages.append(data)
+        return "added"
+
+    def recordChanges(self): pass
+
+    def getChanges(self): return []
+
+    def close(self): pass
+
+# --------------------------------------------------------------------
+class PageWriter:
+# --------------------------------------------------------------------
+    """
+    Writes the rendered pages from NUMTHREADS background threads, so
+    that the rendering of the next pages continues while the previous
+    ones are written. At most MAXPENDING pages wait in the queue:
+    when it is full, write() blocks until a thread takes a page.
+    The threads are started on the first write. They write the pages
+    to the DirectoryOutput OUTPUT, and report each page written to the
+    function RECORDWRITE (see Generator.recordWrite()).
+    """
+    def __init__(self, numThreads, maxPending, output, recordWrite):
+        self.numThreads = numThreads
+        self.queue = Queue.Queue(maxPending)
+        self.output = output
+        self.recordWrite = recordWrite
+        self.threads = []
+        self.numPages = 0
+        self.errors = []
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None: return
+            index, filePath, data, pageNode = job
+            # any error is kept for close(): a thread that died would
+            # leave write() blocked on the full queue
+            try:
+                status = self.output.write(filePath, data)
+                self.recordWrite(filePath, data, status)
+            except Exception, e:
+                self.errors.append((index, e, pageNode))
+
+    def write(self, filePath, data, pageNode):
+        """
+        Queue DATA to be written to FILEPATH. PAGENODE is the page, if
+        any, used to locate the errors.
+        """
+        if len(self.threads) == 0:
+            for i in xrange(self.numThreads):
+                thread = threading.Thread(target = self.run)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.queue.put((self.numPages, filePath, data, pageNode))
+        self.numPages += 1
+
+    def hasFailed(self):
+        """
+        Returns TRUE if a page could not be written.
+        """
+        return len(self.errors) > 0
+
+    def close(self, raiseErrors = True):
+        """
+        Wait until the queued pages are written and stop the threads.
+        If RAISEERRORS is TRUE, raise a DocError for the first page (in
+        the order of write()) that could not be written.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if raiseErrors and len(self.errors) > 0:
+            index, e, pageNode = min(self.errors)
+            if isinstance(e, DocError): error = e
+            else:                       error = DocError(e.__str__())
+            if pageNode is not None:
+                appendPageLocations(error, pageNode)
+            raise error
+
+# --------------------------------------------------------------------
+class CaptureGenerator(Generator):
+# --------------------------------------------------------------------
+    """
+    A generator that keeps the pages in memory instead of writing
+    them to disk. It is used by the worker processes rendering the
+    pages in parallel.
+    """
+    def __init__(self):
+        Generator.__init__(self, "", output = MemoryOutput())
+        self.pages = self.output.pages
+
+# The pages rendered by the worker processes. The list is set before
+# the workers are forked, so that they inherit the document tree.
+parallelPages = []
+
+def renderParallelPage(index):
+    """
+    Render the page PARALLELPAGES[INDEX] in a worker process. Returns
+    the page content and the environment variables read, or the
+    DocError raised while rendering it.
+    """
+    envReads.clear()
+    generator = CaptureGenerator()
+    try:
+        parallelPages[index].render(generator)
+    except DocError, e:
+        return (None, envReads, e)
+    return (generator.pages[0], envReads, None)
+
+def appendPageLocations(error, pageNode):
+    """
+    Append to ERROR the locations that the guards of PAGENODE and of
+    its ancestors would have added if the page was published serially.
+    """
+    for node in [pageNode] + pageNode.findAncestors():
+        if node.isA(DocSite): break
+        if node.guarded:
+            error.appendLocation(node.getLocation())
+
+def publishParallelPages(generator, pages, numJobs):
+    """
+    Render PAGES using NUMJOBS worker processes and write them with
+    GENERATOR. The pages are written in order, so that the output is
+    the same as if they were rendered one after the other. A DocError
+    raised by a worker is raised again here.
+    """
+    global parallelPages
+    parallelPages = pages
+    pool = multiprocessing.Pool(numJobs)
+    try:
+        chunkSize = max(1, len(pages) / (4 * numJobs))
+        for pageNode, (content, pageEnvReads, error) in \
+                zip(pages, pool.imap(renderParallelPage,
+                                     xrange(len(pages)),
+                                     chunkSize)):
+            if error is not None:
+                appendPageLocations(error, pageNode)
+                raise error
+            envReads.update(pageEnvReads)
+            filePath = os.path.join(generator.dirStack[0],
+                                    pageNode.getPublishPath())
+            try:
+                generator.writeFile(filePath, content, pageNode)
+            except DocError, e:
+                appendPageLocations(e, pageNode)
+                raise
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        parallelPages = []
+
+# --------------------------------------------------------------------
+class BuildManifest:
+# --------------------------------------------------------------------
+    """
+    A record of the inputs used to generate each page: the content
+    hashes of the files contributing to the page and to its template,
+    the hashes of the environment variables read by the %env:
+    directives, and a digest of the site structure (which determines
+    the navigation and the cross-references).
+
+    The manifest of the output directory OUTDIR is stored in the cache
+    directory CACHEDIR if given, so that it is not published with the
+    pages, and in OUTDIR otherwise.
+
+    In an incremental build, the manifest of the previous build is
+    loaded and only the pages whose inputs changed are re-rendered.
+    """
+    fileName = ".webdoc-manifest.json"
+    formatVersion = 2
+
+    def __init__(self, outDir, inputHashes, cacheDir = None):
+        self.outDir = outDir
+        self.inputHashes = inputHashes
+        self.cacheDir = cacheDir
+        self.gzipLevel = 0
+        self.previous = None
+        self.previousPages = []
+        self.removedCopies = []
+        self.pages = {}
+        self.structure = None
+        self.fullRebuild = True
+
+    def getPath(self):
+        if self.cacheDir is None:
+            return os.path.join(self.outDir, self.fileName)
+        key = hashlib.sha1(os.path.abspath(self.outDir)).hexdigest()
+        return os.path.join(self.cacheDir, "manifest", key + ".json")
+
+    def hashEnvValue(self, value):
+        """
+        Returns the digest of the value VALUE of an environment
+        variable (None if not defined), so that the manifest does not
+        hold the value itself.
+        """
+        if value is None: return None
+        return hashlib.sha1(value).hexdigest()
+
+    def getVersion(self):
+        return [self.formatVersion, getCodeFingerprint()]
+
+    def isIncremental(self):
+        """
+        Returns TRUE if the manifest of a previous build was loaded.
+        """
+        return self.previous is not None
+
+    def getNumPages(self):
+        return len(self.pages)
+
+    def setGzipLevel(self, gzipLevel):
+        """
+        Consider stale the pages without a compressed copy if
+        GZIPLEVEL is not 0 (see DirectoryOutput).
+        """
+        self.gzipLevel = gzipLevel
+
+    def load(self, incremental = True):
+        """
+        Load the manifest of the previous build, if any. The list of
+        the pages it generated is always kept (see removeStalePages()).
+        If INCREMENTAL is TRUE and the manifest was produced by the same
+        version of webdoc, it is also used to skip the pages that are
+        up to date.
+        """
+        try:
+            f = open(self.getPath(), "r")
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return
+        if isinstance(data, dict) and isinstance(data.get("pages"), dict):
+            self.previousPages = data["pages"].keys()
+        if not incremental: return
+        if data.get("version") != self.getVersion(): return
+        self.previous = data
+
+    def removeStalePages(self):
+        """
+        Delete the pages generated by the previous build that are no
+        longer part of the site, as well as the directories left
+        empty. Returns the paths of the pages deleted; the paths of
+        their compressed copies deleted are kept in REMOVEDCOPIES.
+        """
+        removed = []
+        self.removedCopies = []
+        outDir = os.path.abspath(self.outDir)
+        for path in self.previousPages:
+            if path in self.pages: continue
+            filePath = os.path.abspath(os.path.join(outDir, path))
+            if not filePath.startswith(outDir + os.sep): continue
+            if not os.path.isfile(filePath): continue
+            os.remove(filePath)
+            if os.path.isfile(filePath + ".gz"):
+                os.remove(filePath + ".gz")
+                self.removedCopies.append(path + ".gz")
+            removed.append(path)
+            dirName = os.path.dirname(filePath)
+            while dirName != outDir and len(os.listdir(dirName)) == 0:
+                os.rmdir(dirName)
+                dirName = os.path.dirname(dirName)
+        return removed
+
+    def save(self):
+        env = {}
+        if not self.fullRebuild:
+            env.update(self.previous["env"])
+        for envName, envValue in envReads.items():
+            env[envName] = self.hashEnvValue(envValue)
+        data = {"version"   : self.getVersion(),
+                "structure" : self.structure,
+                "env"       : env,
+                "pages"     : self.pages}
+        ensureDir(os.path.dirname(os.path.abspath(self.getPath())))
+        f = open(self.getPath(), "w")
+        try:
+            json.dump(data, f, indent = 1, sort_keys = True)
+        finally:
+            f.close()
+
+    def calcStructureHash(self, siteNode):
+        """
+        Compute a digest of the page hierarchy (titles, publish URLs,
+        visibility) and of the URL of every node with a user-supplied
+        ID. If this changes, the navigation or the cross-references of
+        any page may change as well.
+        """
+        h = hashlib.sha1()
+        for page in walkNodes(siteNode, DocPage):
+            if page.parentPage: parentURL = page.parentPage.getPublishURL()
+            else:               parentURL = None
+            h.update(repr((page.getPublishURL(), page.title,
+                           page.hide, parentURL)))
+        # only the IDs supplied by the user are sorted
+        for id, node in sorted((id, node)
+                               for id, node in nodeIndex.iteritems()
+                               if node.attrs.has_key("id")):
+            h.update(repr((id, node.getPublishURL())))
+        return h.hexdigest()
+
+    def prepare(self, siteNode):
+        """
+        Compare the site against the previous build and decide
+        whether all pages must be re-rendered.
+        """
+        self.structure = self.calcStructureHash(siteNode)
+        self.pages = {}
+        prev = self.previous
+        self.fullRebuild = prev is None or prev["structure"] != self.structure
+        if not self.fullRebuild:
+            for envName, envValue in prev["env"].items():
+                if self.hashEnvValue(os.environ.get(envName)) != envValue:
+                    self.fullRebuild = True
+                    break
+
+    def getPageInputs(self, pageNode):
+        """
+        Returns a dictionary mapping the files contributing to the page
+        PAGENODE and to its template to their content hash.
+        """
+        inputs = {}
+        for filePath in pageNode.getSourceFiles():
+            inputs[filePath] = self.inputHashes[filePath]
+        return inputs
+
+    def isPageStale(self, pageNode):
+        """
+        Returns TRUE if PAGENODE must be re-rendered.
+        """
+        if self.fullRebuild: return True
+        path = pageNode.getPublishPath()
+        entry = self.previous["pages"].get(path)
+        if entry is None: return True
+        if entry["inputs"] != self.getPageInputs(pageNode): return True
+        filePath = os.path.join(self.outDir, path)
+        if self.gzipLevel and not os.path.isfile(filePath + ".gz"):
+            return True
+        return not os.path.isfile(filePath)
+
+    def recordPage(self, pageNode):
+        """
+        Record the inputs of PAGENODE in the manifest.
+        """
+        self.pages[pageNode.getPublishPath()] = {
+            "id"     : pageNode.getID(),
+            "inputs" : self.getPageInputs(pageNode)}
+
+# --------------------------------------------------------------------
+class DocInclude(DocNode):
+# --------------------------------------------------------------------
+    __slots__ = ("filePath",)
+
+    def __init__(self, attrs, URL, locator):
+        DocNode.__init__(self, attrs, URL, locator)
+        if not attrs.has_key("src"):
+            raise DocError("include missing 'src' attribute")
+        self.filePath = attrs["src"]
+
+    def __str__(self):
+        return DocNode.__str__(self) + ":<web:include src=%s>" \
+            % xml.sax.saxutils.quoteattr(self.filePath)
+
+# --------------------------------------------------------------------
+class DocDir(DocNode):
+# --------------------------------------------------------------------
+    __slots__ = ("dirName",)
+    guarded = True
+
     def __init__(self, attrs, URL, locator):
         DocNode.__init__(self, attrs, URL, locator)
         if not attrs.has_key("name"):
@@ -539,8 +1991,9 @@ class DocDir(DocNode):
         return DocNode.__str__(self) + ":<web:dir name=%s>" \
             % xml.sax.saxutils.quoteattr(self.dirName)
 
-    def getPublishDirName(self):
-        return self.parent.getPublishDirName() + self.dirName + os.sep
+    def setParent(self, parent):
+        DocNode.setParent(self, parent)
+        self.publishDirName = self.publishDirName + self.dirName + os.sep
 
     def publish(self, generator, pageNode = None):
         generator.changeDir(self.dirName)
@@ -552,15 +2005,22 @@ class DocDir(DocNode):
 # --------------------------------------------------------------------
 class DocGroup(DocNode):
 # --------------------------------------------------------------------
+    __slots__ = ()
+
     def __init__(self, attrs, URL, locator):
         DocNode.__init__(self, attrs, URL, locator)
 
     def __str__(self):
         return DocNode.__str__(self) + ":<web:group>"
 
+    def expand(self, gen, pageNode, stack):
+        stack.extend(reversed(self.children))
+
 # --------------------------------------------------------------------
 class DocCDATAText(DocBareNode):
 # --------------------------------------------------------------------
+    __slots__ = ("text",)
+
     def __init__(self, text):
         DocBareNode.__init__(self)
         self.text = text
@@ -576,24 +2036,35 @@ class DocCDATAText(DocBareNode):
 # --------------------------------------------------------------------
 class DocCDATA(DocNode):
 # --------------------------------------------------------------------
+    __slots__ = ()
+
     def __init__(self):
-        DocNode.__init__(self, {}, None, None)
+        DocNode.__init__(self, emptyAttributes, None, None)
 
     def __str__(self):
         return DocNode.__str__(self) + ":CDATA"
 
     def publish(self, gen, pageNode = None):
+        publishNodes(gen, pageNode, [self])
+
+    def expand(self, gen, pageNode, stack):
         if pageNode is None: return
         gen.putString("<![CDATA[")
-        DocNode.publish(self, gen, pageNode)
-        gen.putString("]]>") ;
+        stack.append(("]]>", None))
+        stack.extend(reversed(self.children))
 
 # --------------------------------------------------------------------
 class DocHtmlText(DocBareNode):
 # --------------------------------------------------------------------
-    def __init__(self, text):
+    __slots__ = ("text", "tokens")
+
+    def __init__(self, text, chunks = None):
         DocBareNode.__init__(self)
         self.text = text
+        if chunks is None:
+            self.tokens = tokenizeText(text)
+        else:
+            self.tokens = tokenizeChunks(chunks)
 
     def __str__(self):
         return DocNode.__str__(self) + ":text:'" + \
@@ -601,56 +2072,22 @@ class DocHtmlText(DocBareNode):
 
     def publish(self, gen, pageNode = None):
         if pageNode is None: return
-        # find occurences of %directive; in the text node and do the
-        # appropriate substitutions
-        next = 0
-        for m in re.finditer("%(\w+)(:.*)?;", self.text):
-            if next < m.start():
-                gen.putXMLString(self.text[next : m.start()])
-            next = m.end()
-            directive = self.text[m.start()+1 : m.end()-1]
-            directive = m.group(1)
-
-            if directive == "content":
-                pageNode.publish(gen, pageNode)
-
-            elif directive == "pagestyle":
-                for s in pageNode.findChildren(DocPageStyle):
-                    s.publish(gen, pageNode)
-
-            elif directive == "pagescript":
-                for s in pageNode.findChildren(DocPageScript):
-                    s.publish(gen, pageNode)
-
-            elif directive == "pagetitle":
-                gen.putString(pageNode.title)
-
-            elif directive == "path":
-                ancPages = [x for x in walkAncestors(pageNode, DocPage)]
-                ancPages.reverse()
-                gen.putString(" - ".join([x.title for x in ancPages]))
-
-            elif directive == "navigation":
-                gen.putString("<ul>\n")
-                openNodeStack = [x for x in walkAncestors(pageNode, DocPage)]
-                siteNode = walkAncestors(pageNode, DocSite).next()
-                siteNode.publishIndex(gen, pageNode, openNodeStack)
-                gen.putString("</ul>\n")
-
-            elif directive == "env":
-                envName = m.group(2)[1:]
-                if envName in os.environ:
-                    gen.putString(os.environ[envName])
-                else:
-                    print "warning: environment variable '%s' not defined" % envName
+        if self.tokens is None:
+            gen.putXMLString(self.text)
+            return
+        # the occurences of %directive; were found when the node was
+        # created (see tokenizeText())
+        for token in self.tokens:
+            if token.__class__ is tuple:
+                publishDirective(gen, pageNode, token[0], token[1])
             else:
-                print "warning: ignoring unknown directive '%s'" % label
-        if next < len(self.text):
-            gen.putXMLString(self.text[next:])
+                gen.putXMLString(token)
 
 # --------------------------------------------------------------------
 class DocCodeText(DocBareNode):
 # --------------------------------------------------------------------
+    __slots__ = ("text",)
+
     def __init__(self, text):
         DocBareNode.__init__(self)
         self.text = text
@@ -659,13 +2096,152 @@ class DocCodeText(DocBareNode):
         return DocNode.__str__(self) + ":text:'" + \
             self.text.encode('utf-8').encode('string_escape') + "'"
 
+# --------------------------------------------------------------------
+class CodeHighlighter:
+# --------------------------------------------------------------------
+    """
+    Highlights code using Pygments. Lexers and the formatter are
+    created once per process. If a cache directory is set, the
+    highlighted code is also stored there, addressed by a hash of the
+    lexer name, formatter options, Pygments version, and code, so
+    that unchanged code is never highlighted again.
+    """
+    def __init__(self):
+        self.cacheDir = None
+        self.lexers = {}
+        self.formatter = None
+
+    def setCacheDir(self, cacheDir):
+        """
+        Store the highlighted code in CACHEDIR.
+        """
+        self.cacheDir = os.path.join(cacheDir, "highlight")
+
+    def getLexer(self, lexerName):
+        """
+        Returns the lexer LEXERNAME, or None if Pygments does not have
+        it.
+        """
+        if lexerName not in self.lexers:
+            try:
+                lexer = pygments.lexers.get_lexer_by_name(lexerName)
+            except pygments.util.ClassNotFound:
+                lexer = None
+            self.lexers[lexerName] = lexer
+        return self.lexers[lexerName]
+
+    def getFormatter(self):
+        if self.formatter is None:
+            self.formatter = pygments.formatters.HtmlFormatter()
+        return self.formatter
+
+    def getCachePath(self, lexerName, code):
+        formatter = self.getFormatter()
+        h = hashlib.sha1(repr((lexerName,
+                               formatter.__class__.__name__,
+                               sorted(formatter.options.items()),
+                               pygments.__version__)))
+        if isinstance(code, unicode): code = code.encode('utf-8')
+        h.update(code)
+        key = h.hexdigest()
+        return os.path.join(self.cacheDir, key[:2], key[2:] + ".html")
+
+    def lookup(self, lexerName, code):
+        """
+        Returns the cached highlighted version of CODE, or None.
+        """
+        if self.cacheDir is None: return None
+        cachePath = self.getCachePath(lexerName, code)
+        try:
+            f = open(cachePath, "rb")
+            try:
+                html = f.read().decode('utf-8')
+            finally:
+                f.close()
+            os.utime(cachePath, None)
+            return html
+        except (IOError, OSError):
+            return None
+
+    def store(self, lexerName, code, html):
+        """
+        Add the highlighted version HTML of CODE to the cache.
+        """
+        if self.cacheDir is None: return
+        cachePath = self.getCachePath(lexerName, code)
+        try:
+            writeCacheFile(cachePath, html.encode('utf-8'))
+        except (IOError, OSError), e:
+            print "warning: could not cache highlighted code: %s" % e
+
+    def highlight(self, lexerName, code):
+        """
+        Returns CODE highlighted as HTML using the lexer LEXERNAME, or
+        None if the lexer does not exist.
+        """
+        lexer = self.getLexer(lexerName)
+        if lexer is None: return None
+        html = self.lookup(lexerName, code)
+        if html is None:
+            html = pygments.highlight(code, lexer, self.getFormatter())
+            self.store(lexerName, code, html)
+        return html
+
+    def highlightNodes(self, codeNodes, numJobs = 1):
+        """
+        Highlight the DocCode nodes CODENODES in advance, storing the
+        result in the nodes. Blocks not found in the cache are grouped
+        by lexer and highlighted by NUMJOBS worker processes.
+        """
+        if not has_pygments: return
+        pending = {}
+        for node in codeNodes:
+            if node.type == "plain" or self.getLexer(node.type) is None:
+                continue
+            code = node.getCode()
+            html = self.lookup(node.type, code)
+            if html is not None:
+                node.highlighted = html
+            else:
+                pending.setdefault((node.type, code), []).append(node)
+
+        jobs = sorted(pending.keys())
+        if numJobs > 1 and hasattr(os, "fork") and len(jobs) > 1:
+            pool = multiprocessing.Pool(numJobs)
+            try:
+                chunkSize = max(1, len(jobs) / (4 * numJobs))
+                results = pool.map(highlightCodeJob, jobs, chunkSize)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = [self.highlight(lexerName, code)
+                       for lexerName, code in jobs]
+        for job, html in zip(jobs, results):
+            for node in pending[job]:
+                node.highlighted = html
+
+codeHighlighter = CodeHighlighter()
+
+def highlightCodeJob(job):
+    """
+    Highlight the code block JOB = (LEXERNAME, CODE) in a worker
+    process.
+    """
+    lexerName, code = job
+    return codeHighlighter.highlight(lexerName, code)
+
 # --------------------------------------------------------------------
 class DocCode(DocNode):
 # --------------------------------------------------------------------
+    __slots__ = ("type", "highlighted")
+
     def __init__(self, attrs, URL = None, locator = None):
         DocNode.__init__(self, attrs, URL, locator)
         self.type = "plain"
         if attrs.has_key("type"): self.type = attrs["type"]
+        self.highlighted = None
 
     def __str__(self):
         str = "<web:precode"
@@ -674,19 +2250,28 @@ class DocCode(DocNode):
             str = str + "> type = " + self.type
         return DocNode.__str__(self) + ":" + str
 
-    def publish(self, gen, pageNode = None):
-        if pageNode is None: return
+    def getCode(self):
+        """
+        Returns the code in the block.
+        """
         code = ""
         for n in self.getChildren():
             if n.isA(DocCodeText):
                 code = code + n.text
+        return code
+
+    def publish(self, gen, pageNode = None):
+        if pageNode is None: return
+        if self.highlighted is not None:
+            gen.putString(self.highlighted)
+            DocNode.publish(self, gen, pageNode)
+            return
+        code = self.getCode()
         if has_pygments and not self.type == "plain":
-            try:
-                lexer = pygments.lexers.get_lexer_by_name(self.type)
-                gen.putString(pygments.highlight(code,
-                                                 lexer,
-                                                 pygments.formatters.HtmlFormatter()))
-            except pygments.util.ClassNotFound:
+            html = codeHighlighter.highlight(self.type, code)
+            if html is not None:
+                gen.putString(html)
+            else:
                 print "warning: could not find a syntax highlighter for '%s'" % self.type
                 gen.putString("<pre>" + code + "</pre>")
         else:
@@ -696,9 +2281,36 @@ class DocCode(DocNode):
 # --------------------------------------------------------------------
 class DocHtmlElement(DocNode):
 # --------------------------------------------------------------------
+    __slots__ = ("tag", "attrTokens", "serialized")
+    guarded = True
+
     def __init__(self, tag, attrs, URL = None, locator = None):
         DocNode.__init__(self, attrs, URL, locator)
         self.tag = tag
+        # the encoded output of the subtree, if it does not depend on
+        # the page: "" until it is serialized (see updateStatic())
+        self.serialized = None
+        # (name, value, tokens) for each attribute (see tokenizeAttr()),
+        # or None if no attribute contains a directive
+        self.attrTokens = None
+        for value in attrs.itervalues():
+            if value.find("%") >= 0:
+                self.attrTokens = [(name, value, tokenizeAttr(value))
+                                   for name, value in attrs.items()]
+                break
+
+    def getUnknownDirectives(self):
+        """
+        Returns the unknown directives found in the attributes.
+        """
+        unknown = []
+        if self.attrTokens is None: return unknown
+        for name, value, tokens in self.attrTokens:
+            if tokens is None: continue
+            for token in tokens:
+                if token.__class__ is tuple and token[0] is None:
+                    unknown.append(token[1])
+        return unknown
 
     def __str__(self):
         str = "<html:" + self.tag
@@ -708,46 +2320,273 @@ class DocHtmlElement(DocNode):
         return DocNode.__str__(self) + ":" + str
 
     def getPublishURL(self):
-        anc = self.findAncestors(DocPage)
-        if len(anc) == 0: return None
-        return anc[0].getPublishURL() + "#" + self.id
+        if self.parentPage is None: return None
+        return self.parentPage.getPublishURL() + "#" + self.id
 
     def publish(self, gen, pageNode = None):
+        publishNodes(gen, pageNode, [self])
+
+    def updateStatic(self):
+        """
+        Mark the element as static if its output does not depend on
+        the page: no attribute has a directive and all the children
+        are static (see isStaticSubtree()). The output of a static
+        element is serialized the first time it is published, and
+        written at once afterwards.
+        """
+        if self.attrTokens is None and isStaticSubtree(self):
+            self.serialized = ""
+        else:
+            self.serialized = None
+
+    def getSerialized(self):
+        """
+        Returns the encoded output of the element if it is static, or
+        None.
+        """
+        if self.serialized == "":
+            try:
+                self.serialized = serializeNodes([self])
+            except UnicodeEncodeError:
+                # publish it as usual, so that the error is reported
+                # with the location of the offending node
+                self.serialized = None
+        return self.serialized
+
+    def expand(self, gen, pageNode, stack):
         if pageNode is None: return
-        gen.putString("<")
-        gen.putString(self.tag)
-        for name, value in self.attrs.items():
-            gen.putString(" ")
-            gen.putString(name)
-            gen.putString("=")
-            gen.putXMLAttr(expandAttr(value, pageNode))
+        if self.serialized is not None:
+            serialized = self.getSerialized()
+            if serialized is not None:
+                gen.putEncoded(serialized)
+                return
+        if self.tag == 'br':
+            stack.append((None, self))
+        else:
+            stack.append(("</" + self.tag + ">", self))
+        gen.putString("<" + self.tag)
+        if self.attrTokens is None:
+            for name, value in self.attrs.items():
+                gen.putString(" " + name + "=")
+                gen.putXMLAttr(value)
+        else:
+            for name, value, tokens in self.attrTokens:
+                gen.putString(" " + name + "=")
+                if tokens is not None:
+                    value = expandAttrTokens(tokens, pageNode)
+                gen.putXMLAttr(value)
         if self.tag == 'br':
             # workaround for browser that do not like <br><br/>
             gen.putString("/>")
         else:
             gen.putString(">")
-            DocNode.publish(self, gen, pageNode)
-            gen.putString("</")
-            gen.putString(self.tag)
-            gen.putString(">")
+            stack.extend(reversed(self.children))
 
-    publish = makeGuard(publish)
+# --------------------------------------------------------------------
+def isStaticSubtree(node):
+# --------------------------------------------------------------------
+    """
+    Returns True if the children of NODE are static: HTML elements
+    marked as static (see DocHtmlElement.updateStatic()), text
+    without directives, and CDATA sections containing only such text.
+    """
+    stack = list(node.children)
+    while len(stack) > 0:
+        child = stack.pop()
+        nodeType = child.__class__
+        if nodeType is DocHtmlElement:
+            if child.serialized is None: return False
+        elif nodeType is DocHtmlText:
+            if child.tokens is not None: return False
+        elif nodeType is DocCDATA:
+            stack.extend(child.children)
+        elif nodeType is not DocCDATAText:
+            return False
+    return True
+
+def serializeNodes(nodes):
+    """
+    Returns the encoded output of the static NODES (see
+    isStaticSubtree()), as DocHtmlElement.expand() and the other
+    publish methods would write it.
+    """
+    chunks = []
+    stack = list(reversed(nodes))
+    while len(stack) > 0:
+        item = stack.pop()
+        nodeType = item.__class__
+        if nodeType is DocHtmlText:
+            chunks.append(escapeXMLString(item.text))
+        elif nodeType is DocHtmlElement:
+            chunks.append(u"<" + item.tag)
+            for name, value in item.attrs.items():
+                chunks.append(u" " + name + u"=" +
+                              xml.sax.saxutils.quoteattr(value))
+            if item.tag == 'br':
+                chunks.append(u"/>")
+            else:
+                chunks.append(u">")
+                stack.append(u"</" + item.tag + u">")
+                stack.extend(reversed(item.children))
+        elif nodeType is DocCDATAText:
+            chunks.append(item.text)
+        elif nodeType is DocCDATA:
+            chunks.append(u"<![CDATA[")
+            stack.append(u"]]>")
+            stack.extend(reversed(item.children))
+        else:
+            chunks.append(item)
+    return u"".join(chunks).encode('latin-1')
 
 # --------------------------------------------------------------------
 class DocTemplate(DocNode):
 # --------------------------------------------------------------------
+    __slots__ = ("sourceFiles", "renderPlan")
+    guarded = True
+
     def __init__(self, attrs, URL, locator):
         DocNode.__init__(self, attrs, URL, locator)
+        self.sourceFiles = set()
+        self.renderPlan = None
+
+    def addSourceFile(self, filePath):
+        """
+        Record that FILEPATH contributes to the template.
+        """
+        self.sourceFiles.add(filePath)
+
+    def getRenderPlan(self):
+        """
+        Returns the DocRenderPlan of the template, compiling it the
+        first time.
+        """
+        if self.renderPlan is None:
+            self.renderPlan = DocRenderPlan(self)
+        return self.renderPlan
 
     def publish(self, generator, pageNode = None):
         if pageNode is None: return
-        DocNode.publish(self, generator, pageNode)
+        self.getRenderPlan().publish(generator, pageNode)
 
     publish = makeGuard(publish)
 
+# --------------------------------------------------------------------
+class DocRenderPlan:
+# --------------------------------------------------------------------
+    """
+    A template compiled for fast rendering. The template subtree is
+    flattened into a list of items, which are either strings of
+    static (already escaped and encoded) output, or slots, i.e. the
+    parts of the output that depend on the page: the directives in
+    the text nodes, the attributes containing directives, and the
+    nodes that are published as usual (such as code blocks).
+
+    Each slot also lists the guarded nodes enclosing it, innermost
+    first, so that a DocError raised while filling the slot carries
+    the same locations as if the template was published recursively.
+    """
+    def __init__(self, templateNode):
+        self.items = []
+        self.static = []
+        self.compileChildren(templateNode, [])
+        self.flushStatic()
+
+    def flushStatic(self):
+        if len(self.static) > 0:
+            self.items.append("".join(self.static))
+            self.static = []
+
+    def addStatic(self, str):
+        try:
+            self.static.append(str.encode('latin-1'))
+        except UnicodeEncodeError, e:
+            raise DocError(e.__str__())
+
+    def addSlot(self, kind, argument, guards):
+        self.flushStatic()
+        self.items.append((kind, argument, guards))
+
+    def compileChildren(self, node, guards):
+        for c in node.getChildren():
+            self.compileNode(c, guards)
+
+    def compileNode(self, node, guards):
+        if node.__class__ is DocHtmlText:
+            if node.tokens is None:
+                self.addStatic(escapeXMLString(node.text))
+                return
+            for token in node.tokens:
+                if token.__class__ is tuple:
+                    self.addSlot(token[0], token[1], guards)
+                else:
+                    self.addStatic(escapeXMLString(token))
+
+        elif node.__class__ is DocHtmlElement and \
+                node.getSerialized() is not None:
+            self.static.append(node.serialized)
+
+        elif node.__class__ is DocHtmlElement:
+            elementGuards = [node] + guards
+            self.addStatic("<" + node.tag)
+            if node.attrTokens is None:
+                attrTokens = [(name, value, None)
+                              for name, value in node.attrs.items()]
+            else:
+                attrTokens = node.attrTokens
+            for name, value, tokens in attrTokens:
+                self.addStatic(" " + name + "=")
+                if tokens is not None:
+                    self.addSlot("attr", tokens, elementGuards)
+                else:
+                    self.addStatic(xml.sax.saxutils.quoteattr(value))
+            if node.tag == 'br':
+                self.addStatic("/>")
+            else:
+                self.addStatic(">")
+                self.compileChildren(node, elementGuards)
+                self.addStatic("</" + node.tag + ">")
+
+        elif node.__class__ is DocCDATAText:
+            self.addStatic(node.text)
+
+        elif node.__class__ is DocCDATA:
+            self.addStatic("<![CDATA[")
+            self.compileChildren(node, guards)
+            self.addStatic("]]>")
+
+        elif node.__class__ is DocGroup:
+            self.compileChildren(node, guards)
+
+        else:
+            self.addSlot("node", node, guards)
+
+    def publish(self, gen, pageNode):
+        """
+        Publish the template for the page PAGENODE.
+        """
+        for item in self.items:
+            if item.__class__ is str:
+                gen.putEncoded(item)
+                continue
+            kind, argument, guards = item
+            try:
+                if kind == "attr":
+                    gen.putXMLAttr(expandAttrTokens(argument, pageNode))
+                elif kind == "node":
+                    argument.publish(gen, pageNode)
+                else:
+                    publishDirective(gen, pageNode, kind, argument)
+            except DocError, e:
+                for node in guards:
+                    e.appendLocation(node.getLocation())
+                raise
+
 # --------------------------------------------------------------------
 class DocPageStyle(DocNode):
 # --------------------------------------------------------------------
+    __slots__ = ()
+    guarded = True
+
     def __init__(self, attrs, URL, locator):
         DocNode.__init__(self, attrs, URL, locator)
 
@@ -778,6 +2617,9 @@ class DocPageStyle(DocNode):
 # --------------------------------------------------------------------
 class DocPageScript(DocNode):
 # --------------------------------------------------------------------
+    __slots__ = ()
+    guarded = True
+
     def __init__(self, attrs, URL, locator):
         DocNode.__init__(self, attrs, URL, locator)
 
@@ -802,6 +2644,8 @@ class DocPageScript(DocNode):
 class DocPage(DocNode):
 # --------------------------------------------------------------------
     counter = 0
+    __slots__ = ("templateID", "name", "title", "hide", "sourceFiles")
+    guarded = True
 
     def __init__(self, attrs, URL, locator):
         DocNode.__init__(self, attrs, URL, locator)
@@ -810,6 +2654,7 @@ class DocPage(DocNode):
         self.name  = "page%d" % DocPage.counter
         self.title = "untitled"
         self.hide = False
+        self.sourceFiles = set()
 
         for k, v in self.attrs.items():
             if k == 'src':
@@ -822,6 +2667,8 @@ class DocPage(DocNode):
                 self.title = v
             elif k == 'hide':
                 self.hide = (v.lower() == 'yes')
+            elif k == 'template':
+                self.templateID = v
             else:
                 raise DocError(
                     "web:page cannot have '%s' attribute" % k)
@@ -831,57 +2678,82 @@ class DocPage(DocNode):
             % (xml.sax.saxutils.escape(self.name),
                xml.sax.saxutils.escape(self.title))
 
+    def addSourceFile(self, filePath):
+        """
+        Record that FILEPATH contributes to the content of the page.
+        """
+        self.sourceFiles.add(filePath)
+
+    def getSourceFiles(self):
+        """
+        Returns the set of the files contributing to the content of
+        the page and to its template.
+        """
+        files = set(self.sourceFiles)
+        if nodeIndex.has_key(self.templateID):
+            files |= nodeIndex[self.templateID].sourceFiles
+        return files
+
     def getPublishFileName(self):
         return self.name + ".html"
 
+    def getPublishPath(self):
+        """
+        Returns the path of the page file relative to the output
+        directory.
+        """
+        return self.getPublishDirName() + self.getPublishFileName()
+
     def getPublishURL(self):
-        siteNode = self.findAncestors(DocSite)[0]
-        return siteNode.getPublishURL() + \
+        return self.parentSite.getPublishURL() + \
             self.getPublishDirName() + \
             self.getPublishFileName()
 
     def publish(self, generator, pageNode = None):
         if not pageNode:
-            generator.open(self.getPublishFileName())
-            templateNode = nodeIndex[self.templateID]
-            templateNode.publish(generator, self)
-            generator.close()
+            manifest = generator.manifest
+            if manifest is None or manifest.isPageStale(self):
+                generator.publishPage(self)
+            if manifest is not None:
+                manifest.recordPage(self)
             DocNode.publish(self, generator, None)
-        elif pageNode is self:
-            DocNode.publish(self, generator, pageNode)
-
-    def publishIndex(self, gen, pageNode, openNodeStack):
-        if self.hide: return
-        gen.putString("<li><a href=")
-        gen.putXMLAttr(
-            expandAttr("%%pathto:%s;" % self.getID(), pageNode))
-        if len(openNodeStack) == 1 and self == openNodeStack[0]:
-            gen.putString(" class='active' ")
-        gen.putString(">")
-        gen.putXMLString(self.title)
-        gen.putString("</a>\n")
-        pos = gen.tell()
-        gen.putString("<ul>\n")
-        hasIndexedChildren = False
-        if len(openNodeStack) > 0 and self == openNodeStack[-1]:
-            openNodeStack.pop()
-            hasIndexedChildren = DocNode.publishIndex(self, gen, pageNode, openNodeStack)
-        if hasIndexedChildren:
-            gen.putString("</ul>")
-        else:
-            gen.seek(pos)
-        gen.putString("</li>\n")
-        return True
+        elif pageNode is self:
+            DocNode.publish(self, generator, pageNode)
+
+    def render(self, generator):
+        """
+        Render the page by publishing its template.
+        """
+        if not nodeIndex.has_key(self.templateID) or \
+                not nodeIndex[self.templateID].isA(DocTemplate):
+            raise DocError("could not find the template '%s'" % self.templateID)
+        generator.open(self.getPublishFileName(), self)
+        templateNode = nodeIndex[self.templateID]
+        templateNode.publish(generator, self)
+        generator.close()
 
     publish = makeGuard(publish)
 
 # --------------------------------------------------------------------
 class DocSite(DocNode):
 # --------------------------------------------------------------------
+    __slots__ = ("siteURL", "outDir", "manifest", "numJobs", "numWriters",
+                 "changesFile", "archive", "gzipLevel", "previewPages",
+                 "navigation")
+    guarded = True
+
     def __init__(self, attrs, URL, locator):
         DocNode.__init__(self, attrs, URL, locator)
         self.siteURL = "http://www.foo.org/"
         self.outDir = "html"
+        self.manifest = None
+        self.numJobs = 1
+        self.numWriters = 0
+        self.changesFile = None
+        self.archive = None
+        self.gzipLevel = 0
+        self.previewPages = None
+        self.navigation = None
 
     def __str__(self):
         return DocNode.__str__(self) + ":<web:site>"
@@ -895,15 +2767,460 @@ class DocSite(DocNode):
     def getOutDir(self):
         return self.outDir
 
+    def getNavigation(self):
+        """
+        Returns the DocNavigation object of the site.
+        """
+        if self.navigation is None:
+            self.navigation = DocNavigation(self)
+        return self.navigation
+
     def setOutDir(self, outDir):
         self.outDir = outDir
 
+    def setNumJobs(self, numJobs):
+        """
+        Render the pages using NUMJOBS processes.
+        """
+        self.numJobs = numJobs
+
+    def setNumWriters(self, numWriters):
+        """
+        Write the pages using NUMWRITERS background threads (see
+        PageWriter).
+        """
+        self.numWriters = numWriters
+
+    def setChangesFile(self, changesFile):
+        """
+        Write the list of the output files changed by the build to
+        CHANGESFILE (see Generator.saveChanges()).
+        """
+        self.changesFile = changesFile
+
+    def setArchive(self, fileName, stream = None):
+        """
+        Write the pages into the archive FILENAME instead of the
+        output directory (see ArchiveOutput).
+        """
+        self.archive = (fileName, stream)
+
+    def setGzipLevel(self, gzipLevel):
+        """
+        Write a copy of each page compressed at the level GZIPLEVEL
+        (1 to 9, 0 for none) next to the page (see DirectoryOutput).
+        """
+        self.gzipLevel = gzipLevel
+
+    def setPreviewPages(self, previewPages):
+        """
+        Also store the pages written in the dictionary PREVIEWPAGES
+        (see DirectoryOutput).
+        """
+        self.previewPages = previewPages
+
+    def setManifest(self, manifest):
+        """
+        Use the build manifest MANIFEST to skip the pages that are
+        up to date and to record the inputs of each page.
+        """
+        self.manifest = manifest
+
+    def highlightCode(self):
+        """
+        Highlight in advance the code blocks of the pages that are going
+        to be rendered, as well as those outside any page (e.g. in
+        templates).
+        """
+        codeNodes = []
+        for node in walkNodes(self, DocCode):
+            if self.manifest is not None:
+                page = node.getParentPage()
+                if page and not self.manifest.isPageStale(page):
+                    continue
+            codeNodes.append(node)
+        codeHighlighter.highlightNodes(codeNodes, self.numJobs)
+
     def publish(self):
-        generator = Generator(self.outDir)
-        DocNode.publish(self, generator)
+        if self.manifest is not None:
+            self.manifest.setGzipLevel(self.gzipLevel)
+            self.manifest.prepare(self)
+        self.highlightCode()
+        crossReferences.resolve(self)
+        numWriters = self.numWriters
+        if self.archive is not None:
+            try:
+                output = ArchiveOutput(*self.archive)
+            except EnvironmentError, e:
+                raise DocError(e.__str__())
+            numWriters = 0
+        else:
+            output = DirectoryOutput(self.outDir, self.gzipLevel,
+                                     self.previewPages)
+            if self.gzipLevel and numWriters == 0:
+                # Compress the pages in the background, while the next
+                # ones are rendered (zlib releases the interpreter lock)
+                numWriters = multiprocessing.cpu_count()
+        generator = Generator(self.outDir, self.manifest, output)
+        if numWriters > 0:
+            generator.setWriter(PageWriter(numWriters,
+                                           4 * numWriters,
+                                           generator.output,
+                                           generator.recordWrite))
+        if self.changesFile is not None:
+            generator.recordChanges()
+        parallel = self.numJobs > 1 and hasattr(os, "fork")
+        if parallel: generator.deferPages()
+        try:
+            DocNode.publish(self, generator)
+            if parallel:
+                publishParallelPages(generator, generator.pendingPages,
+                                     self.numJobs)
+        except:
+            generator.finish(False)
+            raise
+        generator.finish()
+        removed = []
+        if self.manifest is not None:
+            removed = self.manifest.removeStalePages()
+            if self.previewPages is not None:
+                for path in removed: self.previewPages.pop(path, None)
+            self.manifest.save()
+            if self.manifest.isIncremental():
+                print "%d pages rendered, %d up to date" % (
+                    generator.numPagesRendered,
+                    self.manifest.getNumPages() - generator.numPagesRendered)
+        print "%d files written, %d unchanged, %d removed" % (
+            generator.numWritten, generator.numUnchanged, len(removed))
+        if self.changesFile is not None:
+            if self.manifest is not None:
+                removed = removed + self.manifest.removedCopies
+            generator.saveChanges(self.changesFile, removed)
 
     publish = makeGuard(publish)
 
+# --------------------------------------------------------------------
+class DocNavigation:
+# --------------------------------------------------------------------
+    """
+    The site index produced by the %navigation; directive: a nested
+    list of the visible pages, where the pages on the path to the page
+    being rendered (the active page) are expanded.
+
+    The page hierarchy is extracted from the document tree once. The
+    entries of the pages that are not on the active path are
+    collapsed and depend only on the directory of the active page, so
+    they are rendered once per directory and cached.
+    """
+    def __init__(self, siteNode):
+        self.siteNode = siteNode
+        self.childPages = {}
+        self.entries = {}
+
+    def getChildPages(self, node):
+        """
+        Returns the visible pages that are children of NODE in the
+        page hierarchy (i.e. the pages that are descendants of NODE
+        without any other page in between).
+        """
+        if node in self.childPages:
+            return self.childPages[node]
+        pages = []
+        stack = list(node.getChildren())
+        stack.reverse()
+        while len(stack) > 0:
+            n = stack.pop()
+            if n.isA(DocPage):
+                if not n.hide: pages.append(n)
+            else:
+                stack.extend(n.getChildren()[::-1])
+        self.childPages[node] = pages
+        return pages
+
+    def getLinkAndTitle(self, node, pageNode):
+        return (xml.sax.saxutils.quoteattr(
+                expandAttr(u"%%pathto:%s;" % node.getID(), pageNode)),
+                escapeXMLString(node.title))
+
+    def getCollapsedEntry(self, node, pageNode, pageURL):
+        """
+        Returns the index entry of NODE, not expanded, as seen from
+        PAGENODE.
+        """
+        key = (node, pageURL[:pageURL.rfind("/") + 1])
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = u"<li><a href=%s>%s</a>\n</li>\n" % \
+                self.getLinkAndTitle(node, pageNode)
+            self.entries[key] = entry
+        return entry
+
+    def appendEntries(self, chunks, node, pageNode, pageURL, openPages):
+        for child in self.getChildPages(node):
+            if child not in openPages:
+                chunks.append(self.getCollapsedEntry(child, pageNode, pageURL))
+                continue
+            link, title = self.getLinkAndTitle(child, pageNode)
+            chunks.append(u"<li><a href=" + link)
+            if child is pageNode:
+                chunks.append(u" class='active' ")
+            chunks.append(u">" + title + u"</a>\n")
+            if len(self.getChildPages(child)) > 0:
+                chunks.append(u"<ul>\n")
+                self.appendEntries(chunks, child, pageNode, pageURL, openPages)
+                chunks.append(u"</ul>")
+            chunks.append(u"</li>\n")
+
+    def publish(self, gen, pageNode):
+        """
+        Publish the index entries for the active page PAGENODE.
+        """
+        openPages = set(walkAncestors(pageNode, DocPage))
+        chunks = []
+        self.appendEntries(chunks, self.siteNode, pageNode,
+                           pageNode.getPublishURL(), openPages)
+        gen.putString(u"".join(chunks))
+
+# --------------------------------------------------------------------
+class ParseCache:
+# --------------------------------------------------------------------
+    """
+    A cache of parsed files. A file is stored as the list of events
+    that the XML parser delivered to DocHandler, indexed by the hash
+    of the file content. DocHandler rebuilds the document nodes by
+    replaying the events, which is much faster than parsing the file
+    again. Entries are kept in memory, so that a file included several
+    times is parsed once, and, if a cache directory is set, on disk
+    for later builds (the key then includes the version of webdoc).
+    """
+    def __init__(self):
+        self.cacheDir = None
+        self.entries = {}
+
+    def setCacheDir(self, cacheDir):
+        self.cacheDir = os.path.join(cacheDir, "parse")
+
+    def getCachePath(self, contentHash):
+        key = hashlib.sha1(contentHash + getCodeFingerprint()).hexdigest()
+        return os.path.join(self.cacheDir, key[:2], key[2:] + ".pickle")
+
+    def get(self, contentHash):
+        """
+        Returns the events of the file with content hash CONTENTHASH,
+        or None.
+        """
+        events = self.entries.get(contentHash)
+        if events is not None or self.cacheDir is None:
+            return events
+        cachePath = self.getCachePath(contentHash)
+        try:
+            f = open(cachePath, "rb")
+            try:
+                events = cPickle.load(f)
+            finally:
+                f.close()
+            os.utime(cachePath, None)
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+            return None
+        self.entries[contentHash] = events
+        return events
+
+    def put(self, contentHash, events):
+        """
+        Store the events EVENTS of the file with content hash
+        CONTENTHASH.
+        """
+        self.entries[contentHash] = events
+        if self.cacheDir is None: return
+        try:
+            writeCacheFile(self.getCachePath(contentHash),
+                           cPickle.dumps(events, cPickle.HIGHEST_PROTOCOL))
+        except (IOError, OSError), e:
+            print "warning: could not cache parsed file: %s" % e
+
+    def retain(self, contentHashes):
+        """
+        Drop from memory the files whose content hash is not in
+        CONTENTHASHES (e.g. the previous versions of the files edited
+        while watching the site).
+        """
+        for contentHash in self.entries.keys():
+            if contentHash not in contentHashes:
+                del self.entries[contentHash]
+
+parseCache = ParseCache()
+
+# Content of the DTD files, read once per process
+dtdFiles = { }
+
+def readDTDFile(fileName):
+    """
+    Returns the content of the file FILENAME of the local copy of the
+    XHTML DTDs.
+    """
+    if fileName not in dtdFiles:
+        f = open(os.path.join(os.path.dirname(__file__),
+                              'dtd/xhtml1', fileName), "rb")
+        try:
+            dtdFiles[fileName] = f.read()
+        finally:
+            f.close()
+    return dtdFiles[fileName]
+
+# Compact versions of the DTDs, see getCompactDTD()
+compactDTDs = { }
+
+def getCompactDTD(fileName):
+    """
+    Returns a compact version of the DTD FILENAME, containing only the
+    declarations of the general entities and of the element
+    attributes. For a non-validating parser this is equivalent to the
+    full DTD (entities are expanded and default attribute values are
+    added in the same way), but it is a single file, without comments
+    and parameter entities, and it is much faster to process.
+    """
+    if fileName in compactDTDs:
+        return compactDTDs[fileName]
+
+    entities = []
+    attributes = {}
+    elements = []
+    def entityDecl(name, isParameter, value, base, systemId, publicId, notation):
+        if not isParameter and value is not None:
+            entities.append((name, value))
+    def attlistDecl(element, name, type, default, required):
+        if element not in attributes:
+            attributes[element] = []
+            elements.append(element)
+        if name in [x[0] for x in attributes[element]]: return
+        attributes[element].append((name, type, default, required))
+    def externalEntityRef(context, base, systemId, publicId):
+        entityParser = dtdParser.ExternalEntityParserCreate(context)
+        entityParser.Parse(readDTDFile(systemId[systemId.rfind('/')+1:]), True)
+        return 1
+    def literal(value):
+        return '"' + "".join([(32 <= ord(c) < 127 and c not in '&%"<') and c
+                              or "&#%d;" % ord(c) for c in value]) + '"'
+
+    dtdParser = xml.parsers.expat.ParserCreate()
+    dtdParser.SetParamEntityParsing(xml.parsers.expat.XML_PARAM_ENTITY_PARSING_ALWAYS)
+    dtdParser.ExternalEntityRefHandler = externalEntityRef
+    dtdParser.EntityDeclHandler = entityDecl
+    dtdParser.AttlistDeclHandler = attlistDecl
+    dtdParser.Parse('<!DOCTYPE html SYSTEM "%s"><html/>' % fileName, True)
+
+    decls = []
+    for name, value in entities:
+        decls.append("<!ENTITY %s %s>" % (name, literal(value)))
+    for element in elements:
+        attrDecls = []
+        for name, type, default, required in attributes[element]:
+            if default is None:
+                if required: default = "#REQUIRED"
+                else:        default = "#IMPLIED"
+            elif required:
+                default = "#FIXED " + literal(default)
+            else:
+                default = literal(default)
+            attrDecls.append("%s %s %s" % (name, type, default))
+        decls.append("<!ATTLIST %s %s>" % (element, " ".join(attrDecls)))
+    compactDTDs[fileName] = "\n".join(decls)
+    return compactDTDs[fileName]
+
+# --------------------------------------------------------------------
+class ReplayLocator:
+# --------------------------------------------------------------------
+    """
+    A SAX-like locator used while replaying the events of a cached file.
+    """
+    def __init__(self):
+        self.row = None
+        self.column = None
+
+    def getLineNumber(self):
+        return self.row
+
+    def getColumnNumber(self):
+        return self.column
+
+# --------------------------------------------------------------------
+class ExpatReader:
+# --------------------------------------------------------------------
+    """
+    An XML reader driving pyexpat directly. It delivers the same
+    events as the xml.sax parser to a DocHandler, without the
+    intermediate SAX layer. The content is fed in blocks of the size
+    used by xml.sax and the character data is not buffered, so that
+    the text arrives in the same chunks (see tokenizeChunks()). Names
+    are interned in the table used by internString(). The reader also
+    acts as the document locator.
+    """
+    bufferSize = 1 << 16
+
+    def __init__(self, handler, systemId):
+        self.handler = handler
+        self.systemId = systemId
+        self.parser = None
+        self.parserStack = []
+
+    def getLineNumber(self):
+        return self.parser.ErrorLineNumber
+
+    def getColumnNumber(self):
+        return self.parser.ErrorColumnNumber
+
+    def setupParser(self, parser):
+        handler = self.handler
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = handler.endElement
+        parser.CharacterDataHandler = handler.characters
+        parser.CommentHandler = handler.comment
+        parser.StartCdataSectionHandler = handler.startCDATA
+        parser.EndCdataSectionHandler = handler.endCDATA
+        parser.StartDoctypeDeclHandler = self.startDoctype
+        parser.EndDoctypeDeclHandler = handler.endDTD
+        parser.ExternalEntityRefHandler = self.externalEntityRef
+        parser.SetParamEntityParsing(
+            xml.parsers.expat.XML_PARAM_ENTITY_PARSING_UNLESS_STANDALONE)
+
+    def parse(self, content):
+        """
+        Parse the document CONTENT (a byte string).
+        """
+        self.parser = xml.parsers.expat.ParserCreate(
+            None, intern = internedStrings)
+        self.setupParser(self.parser)
+        self.handler.setDocumentLocator(self)
+        for start in xrange(0, len(content), self.bufferSize):
+            self.parser.Parse(content[start : start + self.bufferSize], False)
+        self.parser.Parse("", True)
+        self.handler.endDocument()
+
+    def startElement(self, name, attrs):
+        self.handler.openElement(name, attrs.items())
+
+    def startDoctype(self, name, systemId, publicId, hasInternalSubset):
+        self.handler.startDTD(name, publicId, systemId)
+
+    def externalEntityRef(self, context, base, systemId, publicId):
+        """
+        Parse the external entity SYSTEMID (e.g. the DTD) as resolved by
+        the handler. As for xml.sax, errors in the entity are reported
+        by Expat in the referencing document.
+        """
+        source = self.handler.resolveEntity(publicId, systemId)
+        content = source.getByteStream().read()
+        self.parserStack.append(self.parser)
+        self.parser = self.parser.ExternalEntityParserCreate(context)
+        try:
+            try:
+                self.parser.Parse(content, True)
+            except xml.parsers.expat.ExpatError:
+                return 0
+        finally:
+            self.parser = self.parserStack.pop()
+        return 1
+
 # --------------------------------------------------------------------
 class DocHandler(ContentHandler):
 # --------------------------------------------------------------------
@@ -916,16 +3233,47 @@ class DocHandler(ContentHandler):
         self.filePathStack = []
         self.verbosity = 1
         self.inDTD = False
+        self.dependentStack = []
+        self.inputHashes = {}
+        self.recorder = None
+        self.compactDTD = False
+        self.parsers = []
+        self.parserBackend = "sax"
+        self.pendingText = []
+        self.sharedTextNodes = {}
+        # (file, parent, nodes, includer files, dependent node) for
+        # each file included with <web:include>; NODES is None for the
+        # files included as text (see reloadFile() and IncludeGraph)
+        self.inclusions = []
+
+    def setCompactDTD(self, compactDTD):
+        """
+        Replace the XHTML DTDs with their compact version (see
+        getCompactDTD()).
+        """
+        self.compactDTD = compactDTD
+
+    def setParserBackend(self, parserBackend):
+        """
+        Select the XML parser used to read the input files: either
+        "sax", the generic xml.sax parser, or "expat", which drives
+        pyexpat directly (see ExpatReader). Both build the same tree.
+        """
+        self.parserBackend = parserBackend
 
     def resolveEntity(self, publicid, systemid):
         """
         Resolve XML entities by mapping to a local copy of the (X)HTML
-        DTDs.
+        DTDs. The files are read once and shared by all parsers.
         """
-        return open(os.path.join(
-                os.path.dirname(__file__),
-                'dtd/xhtml1',
-                systemid[systemid.rfind('/')+1:]), "rb")
+        fileName = systemid[systemid.rfind('/')+1:]
+        if self.compactDTD and fileName.endswith(".dtd"):
+            content = getCompactDTD(fileName)
+        else:
+            content = readDTDFile(fileName)
+        source = xml.sax.xmlreader.InputSource(systemid)
+        source.setByteStream(cStringIO.StringIO(content))
+        return source
 
     def lookupFile(self, filePath):
         if os.path.exists(filePath):
@@ -939,6 +3287,23 @@ class DocHandler(ContentHandler):
                 return qualFilePath
         return None
 
+    def addInput(self, qualFilePath, content = None):
+        """
+        Record the content hash of the input file QUALFILEPATH and add
+        the file to the sources of the page (or template) being parsed.
+        """
+        if content is None:
+            f = open(qualFilePath, "rb")
+            try:
+                content = f.read()
+            finally:
+                f.close()
+        contentHash = hashlib.sha1(content).hexdigest()
+        self.inputHashes[qualFilePath] = contentHash
+        if len(self.dependentStack) > 0:
+            self.dependentStack[-1].addSourceFile(qualFilePath)
+        return contentHash
+
     def makeError(self, message):
         e = DocError(message)
         for i in xrange(len(self.filePathStack)-1,-1,-1):
@@ -952,18 +3317,36 @@ class DocHandler(ContentHandler):
     def startElement(self, name, attrs):
         """
         SAX interface: starting of XML element.
+        """
+        self.openElement(name, attrs.items())
+
+    def openElement(self, name, attrItems):
+        """
+        Starting of XML element with attributes ATTRITEMS (a list of
+        name-value pairs).
         The function creates a new document node, i.e. a specialized
         class of DocNode for the type of XML element encountered. It then
         appends it as the head of the parsing stack for further processing."
         """
-        # convert attrs to a dictionary (implicitly copies as required by the doc)
-        attrs_ = {}
-        for k, v in attrs.items():
-            attrs_[k] = v
-        attrs = attrs_
+        # convert attrs to a dictionary (implicitly copies as required
+        # by the doc); since the attributes are published in dictionary
+        # order, the events record the pairs in insertion order, which
+        # reproduces the same dictionary when replayed
+        self.flushText()
+        if len(attrItems) == 0:
+            attrs = emptyAttributes
+        else:
+            attrs = {}
+            for k, v in attrItems:
+                attrs[internString(k)] = v
+        name = internString(name)
 
         URL = self.getCurrentFileName()
         locator = self.getCurrentLocator()
+        if self.recorder is not None:
+            self.recorder.append(("start", name, attrItems,
+                                  locator.getLineNumber(),
+                                  locator.getColumnNumber()))
 
         # The <web:include> element is not parsed recusrively; instead
         # it simply switches to parsing the specified file.
@@ -980,10 +3363,23 @@ class DocHandler(ContentHandler):
                 includeType = attrs["type"]
             else:
                 includeType = "webdoc"
+            parent = self.stack[-1]
+            includerPaths = list(self.filePathStack)
+            dependent = None
+            if len(self.dependentStack) > 0:
+                dependent = self.dependentStack[-1]
             if includeType == "webdoc":
+                start = len(parent.children)
                 self.load(qualFilePath)
+                self.inclusions.append((qualFilePath, parent,
+                                        parent.children[start:],
+                                        includerPaths, dependent))
             elif includeType == "text":
-                self.characters(open(qualFilePath, 'r').read())
+                content = open(qualFilePath, 'r').read()
+                self.addInput(qualFilePath, content)
+                self.addText(content)
+                self.inclusions.append((qualFilePath, parent, None,
+                                        includerPaths, dependent))
             else:
                 raise makeError("'%s' is not a valid <web:include> type" % includeType)
             return
@@ -1012,30 +3408,210 @@ class DocHandler(ContentHandler):
             node = DocCode(attrs, URL, locator)
         else:
             node = DocHtmlElement(name, attrs, URL, locator)
+            if node.attrTokens is not None:
+                for directive in node.getUnknownDirectives():
+                    raise self.makeError(
+                        "unknown directive '%s' found in an attribute" % directive)
 
         if parent: parent.adopt(node)
         self.stack.append(node)
 
+        # pages and templates track the files they are made of
+        if node.isA(DocPage) or node.isA(DocTemplate):
+            node.addSourceFile(URL)
+            self.dependentStack.append(node)
+
     def endElement(self, name):
         """
         SAX interface: closing of XML element.
         """
+        if self.recorder is not None:
+            self.recorder.append(("end", name))
+        self.flushText()
         if name == "include":
             return
         node = self.stack.pop()
+        indexNodeType(node)
+        if node.__class__ is DocHtmlElement:
+            node.updateStatic()
+        if len(self.dependentStack) > 0 and node is self.dependentStack[-1]:
+            self.dependentStack.pop()
         if len(self.stack) == 0:
             self.rootNode = node
 
     def load(self, qualFilePath):
-        self.filePathStack.append(qualFilePath)
-        parser = xml.sax.make_parser()
-        parser.setContentHandler(self)
-        parser.setEntityResolver(self)
-        parser.setProperty(xml.sax.handler.property_lexical_handler, self)
+        f = open(qualFilePath, "rb")
+        try:
+            content = f.read()
+        finally:
+            f.close()
+        contentHash = self.addInput(qualFilePath, content)
+        self.filePathStack.append(internString(qualFilePath))
+
+        # the events delivered by the parser are recorded in a new
+        # list, so that the file does not need to be parsed again
+        parentRecorder = self.recorder
+        events = parseCache.get(contentHash)
+        if events is not None:
+            self.recorder = None
+            self.replay(events)
+            self.recorder = parentRecorder
+            return
+
+        self.recorder = []
+        if self.parserBackend == "expat":
+            reader = ExpatReader(self, qualFilePath)
+            try:
+                reader.parse(content)
+            except xml.parsers.expat.ExpatError, e:
+                raise self.makeError("XML parsing error: %s" %
+                                     xml.parsers.expat.ErrorString(e.code))
+            parseCache.put(contentHash, self.recorder)
+            self.recorder = parentRecorder
+            return
+        if len(self.parsers) > 0:
+            parser = self.parsers.pop()
+        else:
+            parser = xml.sax.make_parser()
+            parser.setContentHandler(self)
+            parser.setEntityResolver(self)
+            parser.setProperty(xml.sax.handler.property_lexical_handler, self)
+        source = xml.sax.xmlreader.InputSource(qualFilePath)
+        source.setByteStream(cStringIO.StringIO(content))
         try:
-            parser.parse(qualFilePath)
+            parser.parse(source)
         except xml.sax.SAXParseException, e:
             raise self.makeError("XML parsing error: %s" % e.getMessage())
+        self.parsers.append(parser)
+        parseCache.put(contentHash, self.recorder)
+        self.recorder = parentRecorder
+
+    def replay(self, events):
+        """
+        Rebuild the nodes of a file from the events recorded when the
+        file was parsed.
+        """
+        locator = ReplayLocator()
+        self.setDocumentLocator(locator)
+        for event in events:
+            kind = event[0]
+            if kind == "start":
+                locator.row = event[3]
+                locator.column = event[4]
+                self.openElement(event[1], event[2])
+            elif kind == "end":
+                self.endElement(event[1])
+            elif kind == "text":
+                self.characters(event[1])
+            elif kind == "comment":
+                self.comment(event[1])
+            elif kind == "startCDATA":
+                self.startCDATA()
+            elif kind == "endCDATA":
+                self.endCDATA()
+        self.endDocument()
+
+    def isAttached(self, node):
+        """
+        Returns True if NODE is part of the document.
+        """
+        while node.parent is not None:
+            node = node.parent
+        return node is self.rootNode
+
+    def reloadFile(self, qualFilePath):
+        """
+        Parse again the file QUALFILEPATH, included once with
+        <web:include>, and replace in the document the nodes made from
+        its previous content. The files that it includes are replayed
+        from the parse cache if they did not change.
+
+        Returns False if the file cannot be reloaded alone (it is the
+        main document, is included as text, or several times, or
+        the names generated for the pages without a name would change),
+        or if it cannot be parsed. The document must then be loaded
+        again, by a new DocHandler, as the tree may have been modified.
+        """
+        if self.rootNode is None: return False
+        inclusions = [x for x in self.inclusions
+                      if x[0] == qualFilePath and self.isAttached(x[1])]
+        if len(inclusions) != 1: return False
+        inclusion = inclusions[0]
+        filePath, parent, oldNodes, includerPaths, dependent = inclusion
+        if oldNodes is None: return False
+        start = 0
+        while start < len(parent.children) and \
+                parent.children[start] is not oldNodes[0]:
+            start += 1
+        end = start + len(oldNodes)
+        if parent.children[start:end] != oldNodes: return False
+
+        oldDocNodes = []
+        for node in oldNodes:
+            oldDocNodes.extend(walkDocNodes(node))
+        oldPages = [x for x in oldDocNodes if x.isA(DocPage)]
+        for page in oldPages:
+            if not page.attrs.has_key("name"): return False
+
+        # remove the nodes from the index, then load the file as if it
+        # was included again, but at the end of the children of PARENT
+        for node in oldDocNodes:
+            if nodeIndex.get(node.id) is node: del nodeIndex[node.id]
+        numChildren = len(parent.children)
+        self.stack = [parent]
+        self.dependentStack = []
+        if dependent is not None: self.dependentStack.append(dependent)
+        self.filePathStack = list(includerPaths)
+        self.locatorStack = [ReplayLocator() for x in includerPaths]
+        try:
+            self.load(qualFilePath)
+        except DocError:
+            return False
+        finally:
+            self.stack = []
+            self.dependentStack = []
+            self.filePathStack = []
+            self.locatorStack = []
+            self.pendingText = []
+        newNodes = parent.children[numChildren:]
+        del parent.children[numChildren:]
+        parent.children[start:end] = newNodes
+        for node in oldNodes:
+            if isinstance(node, DocNode): node.parent = None
+
+        newDocNodes = []
+        for node in newNodes:
+            newDocNodes.extend(walkDocNodes(node))
+        newPages = [x for x in newDocNodes if x.isA(DocPage)]
+        for page in newPages:
+            if not page.attrs.has_key("name"): return False
+        if len(newPages) != len(oldPages):
+            # the pages without a name are numbered in document order
+            for page in nodeTypeIndex[DocPage]:
+                if not page.attrs.has_key("name"): return False
+        if not replaceIndexedNodes(oldDocNodes, newDocNodes):
+            rebuildNodeTypeIndex(self.rootNode)
+
+        # forget what was derived from the previous nodes
+        self.inclusions = [x for x in self.inclusions
+                           if x is not inclusion and self.isAttached(x[1])]
+        self.inclusions.append((qualFilePath, parent, newNodes,
+                                includerPaths, dependent))
+        for node in walkAncestors(parent):
+            if node.__class__ is DocHtmlElement:
+                node.updateStatic()
+            elif node.isA(DocTemplate):
+                node.renderPlan = None
+        if self.rootNode.isA(DocSite):
+            self.rootNode.navigation = None
+        crossReferences.reset()
+        return True
+
+    def getIncludeGraph(self):
+        """
+        Returns the IncludeGraph of the document loaded.
+        """
+        return IncludeGraph(self)
 
     def setDocumentLocator(self, locator):
         self.locatorStack.append(locator)
@@ -1050,15 +3626,73 @@ class DocHandler(ContentHandler):
         """
         SAX interface: characters.
         """
+        if self.recorder is not None:
+            self.recorder.append(("text", content))
+        self.addText(content)
+
+    def addText(self, content):
+        """
+        Add the text CONTENT to the current node. Adjacent chunks of
+        character data are merged in a single text node, which is
+        created by flushText() before the next structural event.
+        """
+        self.pendingText.append(content)
+
+    def flushText(self):
+        """
+        Add the pending character data (see addText()) to the current
+        node as a single text node.
+        """
+        if len(self.pendingText) == 0:
+            return
+        chunks = self.pendingText
+        if len(chunks) == 1:
+            content = chunks[0]
+            chunks = None
+        else:
+            content = "".join(chunks)
+        self.pendingText = []
         parent = self.stack[-1]
         if parent.isA(DocCDATA):
-            node = DocCDATAText(content)
+            nodeType = DocCDATAText
         elif parent.isA(DocCode):
-            node = DocCodeText(content)
+            nodeType = DocCodeText
+        else:
+            nodeType = DocHtmlText
+        # text nodes have no parent, so those made only of white space
+        # (e.g. the indentation) are shared
+        if content.isspace():
+            key = (nodeType, content)
+            node = self.sharedTextNodes.get(key)
+            if node is None:
+                node = nodeType(content)
+                self.sharedTextNodes[key] = node
+        elif nodeType is DocHtmlText:
+            # the directives are found in each chunk separately
+            node = DocHtmlText(content, chunks)
+            if node.tokens is not None:
+                self.checkDirectives(node)
         else:
-            node = DocHtmlText(content)
+            node = nodeType(content)
         parent.adopt(node)
 
+    def checkDirectives(self, node):
+        """
+        Warn about the unknown directives of the text node NODE, and
+        drop them, so that they are not reported again for each page.
+        """
+        tokens = []
+        for token in node.tokens:
+            if token.__class__ is tuple and token[0] not in textDirectives:
+                locator = self.getCurrentLocator()
+                print "warning: %s: ignoring unknown directive '%s'" % (
+                    DocLocation(self.getCurrentFileName(),
+                                locator.getLineNumber(),
+                                locator.getColumnNumber()), token[0])
+                continue
+            tokens.append(token)
+        node.tokens = tuple(tokens)
+
     def ignorableWhitespace(self, ws):
         self.characters(ws)
 
@@ -1070,17 +3704,27 @@ class DocHandler(ContentHandler):
         self.filePathStack.pop()
 
     def startCDATA(self):
+        if self.recorder is not None:
+            self.recorder.append(("startCDATA",))
+        self.flushText()
         node = DocCDATA()
         self.stack[-1].adopt(node)
         self.stack.append(node)
 
     def endCDATA(self):
+        if self.recorder is not None:
+            self.recorder.append(("endCDATA",))
+        self.flushText()
         node = self.stack.pop()
+        indexNodeType(node)
         if len(self.stack) == 0:
             self.rootNode = node
 
     def comment(self, body):
         if self.inDTD: return
+        if self.recorder is not None:
+            self.recorder.append(("comment", body))
+        self.flushText()
         node = DocCDATAText("<!--" + body + "-->")
         self.stack[-1].adopt(node)
 
@@ -1094,23 +3738,156 @@ class DocHandler(ContentHandler):
         self.inDTD = False
 
 # --------------------------------------------------------------------
-if __name__ == '__main__':
+class IncludeGraph:
 # --------------------------------------------------------------------
-    (opts, args) = parser.parse_args()
+    """
+    The dependencies among the input files of the document loaded by
+    HANDLER: the files that each file includes with <web:include>
+    (either type), and the pages whose content or template comes from
+    each file. A change to a file requires rendering again only the
+    latter, unless it also changes the page titles or hierarchy, which
+    appear in the navigation of every page (see BuildManifest).
+
+    The paths given to the queries are normalized, so that any path to
+    an input file can be used; the paths returned are those recorded
+    by the DocHandler.
+    """
+    def __init__(self, handler):
+        self.inputs = {}
+        self.includes = {}
+        self.includers = {}
+        self.pages = {}
+        self.allPages = []
+        for filePath in handler.inputHashes:
+            self.inputs[self.getKey(filePath)] = filePath
+        for inclusion in handler.inclusions:
+            filePath, parent, nodes, includerPaths, dependent = inclusion
+            if not handler.isAttached(parent): continue
+            includerPath = includerPaths[-1]
+            included = self.includes.setdefault(self.getKey(includerPath), [])
+            if filePath not in included: included.append(filePath)
+            includers = self.includers.setdefault(self.getKey(filePath), [])
+            if includerPath not in includers: includers.append(includerPath)
+        if handler.rootNode is None: return
+        # the pages in document order (a page before its subpages)
+        stack = [handler.rootNode]
+        while len(stack) > 0:
+            node = stack.pop()
+            if not isinstance(node, DocNode): continue
+            if node.isA(DocPage): self.allPages.append(node)
+            stack.extend(node.children[::-1])
+        for page in self.allPages:
+            for filePath in page.getSourceFiles():
+                self.pages.setdefault(self.getKey(filePath), []).append(page)
+
+    def getKey(self, filePath):
+        return os.path.normcase(os.path.abspath(filePath))
+
+    def hasFile(self, filePath):
+        """
+        Returns True if FILEPATH is an input file of the document.
+        """
+        return self.getKey(filePath) in self.inputs
 
-    if not has_pygments and opts.verb:
-        print "warning: pygments module not found: syntax coloring disabled"
+    def getFiles(self):
+        """
+        Returns the input files of the document.
+        """
+        return sorted(self.inputs.values())
 
-    filePath = args[0]
-    handler = DocHandler()
-    try:
-        handler.load(filePath)
-    except DocError, e:
-        print e
-        sys.exit(-1)
+    def getIncludedFiles(self, filePath):
+        """
+        Returns the files included by FILEPATH, in document order.
+        """
+        return list(self.includes.get(self.getKey(filePath), []))
+
+    def getIncluders(self, filePath):
+        """
+        Returns the files that include FILEPATH.
+        """
+        return list(self.includers.get(self.getKey(filePath), []))
+
+    def getPages(self, filePath):
+        """
+        Returns the DocPages whose content or template comes (in part)
+        from FILEPATH, in document order.
+        """
+        return list(self.pages.get(self.getKey(filePath), []))
+
+    def getAffectedPages(self, filePaths):
+        """
+        Returns the DocPages whose content or template comes from any
+        of the files FILEPATHS, in document order.
+        """
+        pages = set()
+        for filePath in filePaths:
+            for page in self.pages.get(self.getKey(filePath), []):
+                pages.add(id(page))
+        return [x for x in self.allPages if id(x) in pages]
+
+# --------------------------------------------------------------------
+def resetDocumentState():
+# --------------------------------------------------------------------
+    """
+    Forget the document loaded by the previous DocHandler (the node
+    indexes, the ID counters, the cross-references, and the
+    environment variables read), so that the document can be loaded
+    again in the same process.
+    """
+    nodeIndex.clear()
+    nodeTypeIndex.clear()
+    nodeIDAllocator.reset()
+    crossReferences.reset()
+    envReads.clear()
+    DocPage.counter = 0
+
+# --------------------------------------------------------------------
+def loadSite(handler, filePath, opts):
+# --------------------------------------------------------------------
+    """
+    Load the document FILEPATH with HANDLER, as configured by the
+    command line options OPTS. Raises a DocError if the document
+    cannot be loaded.
+    """
+    handler.setCompactDTD(opts.compactdtd)
+    handler.setParserBackend(opts.parser)
+    handler.load(filePath)
+
+    if opts.memoryreport:
+        print "== Memory =="
+        reportMemory(handler.rootNode)
 
+# --------------------------------------------------------------------
+def publishSite(handler, opts, incremental, archiveStream = None,
+                previewPages = None):
+# --------------------------------------------------------------------
+    """
+    Publish the document loaded by HANDLER, as configured by the
+    command line options OPTS. If INCREMENTAL is true, only the pages
+    whose inputs changed are rendered. Raises a DocError if the
+    document cannot be published.
+    """
     # configure
     handler.rootNode.setOutDir(opts.outdir)
+    if opts.archive is not None:
+        handler.rootNode.setArchive(opts.archive, archiveStream)
+    else:
+        # the manifest is kept only if needed, as it is published
+        # with the pages unless it is in the cache directory
+        manifest = None
+        if incremental or opts.watch or opts.changes is not None or \
+                opts.cachedir is not None:
+            manifest = BuildManifest(opts.outdir, handler.inputHashes,
+                                     opts.cachedir)
+            manifest.load(incremental)
+        handler.rootNode.setManifest(manifest)
+    handler.rootNode.setNumJobs(opts.jobs)
+    handler.rootNode.setNumWriters(opts.writers)
+    handler.rootNode.setGzipLevel(opts.gzip)
+    handler.rootNode.setChangesFile(opts.changes)
+    handler.rootNode.setPreviewPages(previewPages)
+    if opts.cachedir is not None:
+        codeHighlighter.setCacheDir(opts.cachedir)
 
     #print "== Index Content =="
     # dumpIndex()
@@ -1118,14 +3895,271 @@ if __name__ == '__main__':
     #print "== Node Tree =="
     #handler.rootNode.dump()
 
-    print "== All pages =="
-    for x in walkNodes(handler.rootNode, DocPage):
-        print x
+    if handler.verbosity > 0:
+        print "== All pages =="
+        for x in walkNodes(handler.rootNode, DocPage):
+            print x
 
     print "== Publish =="
+    handler.rootNode.publish()
+    if opts.cachedir is not None:
+        pruneCache(opts.cachedir, opts.cachesize * 1024 * 1024)
+
+# --------------------------------------------------------------------
+class SiteWatcher:
+# --------------------------------------------------------------------
+    """
+    Rebuilds the site loaded by HANDLER when one of its input files
+    (the files read through DocHandler.load() and <web:include>)
+    changes. The files are polled every POLLINTERVAL seconds.
+
+    The document stays in memory: the files changed are parsed again
+    and their nodes replaced in the tree (see DocHandler.reloadFile()).
+    If this is not possible, the whole document is loaded again, but
+    only the files changed are parsed; the others are replayed from
+    the events kept in memory by the parse cache. In both cases, the
+    build manifest limits the rendering to the pages affected by the
+    change.
+    """
+    def __init__(self, handler, filePath, opts, previewPages = None,
+                 pollInterval = 0.1):
+        self.handler = handler
+        self.filePath = filePath
+        self.opts = opts
+        self.previewPages = previewPages
+        self.pollInterval = pollInterval
+
+    def getSnapshot(self, filePaths):
+        """
+        Returns a dictionary mapping each of FILEPATHS to its
+        modification time and size, or to None if it does not exist.
+        """
+        snapshot = {}
+        for filePath in filePaths:
+            try:
+                st = os.stat(filePath)
+                snapshot[filePath] = (st.st_mtime, st.st_size)
+            except OSError:
+                snapshot[filePath] = None
+        return snapshot
+
+    def watch(self):
+        """
+        Watch the input files until interrupted.
+        """
+        snapshot = self.getSnapshot(self.handler.inputHashes.keys())
+        print "== Watching %d files ==" % len(snapshot)
+        while True:
+            time.sleep(self.pollInterval)
+            current = self.getSnapshot(snapshot.keys())
+            changed = [x for x in current if current[x] != snapshot[x]]
+            if len(changed) == 0: continue
+            for filePath in sorted(changed):
+                print "changed: %s" % filePath
+            startTime = time.time()
+            self.rebuild(changed)
+            print "rebuilt in %d ms" % ((time.time() - startTime) * 1000)
+            # watch the files included for the first time as well; the
+            # others keep the state seen before the rebuild, so that a
+            # change made during the rebuild is not missed
+            newFiles = [x for x in self.handler.inputHashes
+                        if x not in current]
+            current.update(self.getSnapshot(newFiles))
+            snapshot = current
+
+    def rebuild(self, changedFiles):
+        """
+        Rebuild the site after a change to the files CHANGEDFILES.
+        """
+        handler = self.handler
+        reloaded = True
+        for filePath in changedFiles:
+            if not reloaded: break
+            try:
+                f = open(filePath, "rb")
+                try:
+                    content = f.read()
+                finally:
+                    f.close()
+            except EnvironmentError:
+                reloaded = False
+                break
+            # a file included by another file reloaded is up to date
+            contentHash = hashlib.sha1(content).hexdigest()
+            if handler.inputHashes.get(filePath) == contentHash: continue
+            reloaded = handler.reloadFile(filePath)
+        try:
+            if not reloaded:
+                resetDocumentState()
+                handler = self.handler = DocHandler()
+                if not self.opts.verb: handler.verbosity = 0
+                loadSite(handler, self.filePath, self.opts)
+            publishSite(handler, self.opts, True,
+                        previewPages = self.previewPages)
+        except DocError, e:
+            print e
+            # load the whole document the next time
+            handler.rootNode = None
+        parseCache.retain(set(handler.inputHashes.values()))
+
+# --------------------------------------------------------------------
+class PreviewServer:
+# --------------------------------------------------------------------
+    """
+    An HTTP server on localhost serving the pages of the site while
+    it is watched. The pages are served from PAGES, the dictionary
+    filled by DirectoryOutput as they are written, or else from the
+    output directory OUTDIR (e.g. the pages not rendered again since
+    an earlier incremental build).
+    """
+    def __init__(self, port, outDir):
+        self.outDir = outDir
+        self.pages = {}
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", port),
+                                                PreviewRequestHandler)
+        self.server.preview = self
+
+    def start(self):
+        """
+        Serve the requests from a background thread.
+        """
+        thread = threading.Thread(target = self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print "serving the pages at http://localhost:%d/" % \
+            self.server.server_address[1]
+
+    def getPage(self, URLPath):
+        """
+        Returns the content of the page at URLPATH, or None.
+        """
+        path = urllib.unquote(urlparse(URLPath).path)
+        if path.endswith("/"): path += "index.html"
+        path = os.path.normpath(path.lstrip("/"))
+        if path.startswith(os.pardir) or os.path.isabs(path): return None
+        data = self.pages.get(path)
+        if data is not None: return data
+        filePath = os.path.join(self.outDir, path)
+        if os.path.isdir(filePath):
+            filePath = os.path.join(filePath, "index.html")
+        try:
+            f = open(filePath, "rb")
+            try:
+                return f.read()
+            finally:
+                f.close()
+        except EnvironmentError:
+            return None
+
+# --------------------------------------------------------------------
+class PreviewRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+# --------------------------------------------------------------------
+    def do_GET(self):
+        data = self.sendHeaders()
+        if data is not None: self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.sendHeaders()
+
+    def sendHeaders(self):
+        """
+        Send the status and headers of the response. Returns the page
+        requested, or None.
+        """
+        data = self.server.preview.getPage(self.path)
+        if data is None:
+            self.send_error(404)
+            return None
+        contentType = mimetypes.guess_type(urlparse(self.path).path)[0]
+        if contentType is None: contentType = "text/html"
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        return data
+
+    def log_message(self, format, *args): pass
+
+# --------------------------------------------------------------------
+if __name__ == '__main__':
+# --------------------------------------------------------------------
+    (opts, args) = parser.parse_args()
+
+    if opts.archive is not None and \
+            getArchiveFormat(opts.archive) is None:
+        parser.error("unknown archive format for '%s' "
+                     "(use .zip, .tar, .tar.gz, .tar.bz2, or -)" % opts.archive)
+    if opts.archive is not None and opts.incremental:
+        parser.error("--archive cannot be used with --incremental")
+    if opts.archive is not None and opts.gzip:
+        parser.error("--archive cannot be used with --gzip")
+    if opts.gzip < 0 or opts.gzip > 9:
+        parser.error("the --gzip level must be between 0 and 9")
+    if opts.watch and opts.archive is not None:
+        parser.error("--watch cannot be used with --archive")
+    if opts.serve is not None and not opts.watch:
+        parser.error("--serve requires --watch")
+    if opts.affected and (opts.watch or opts.archive is not None):
+        parser.error("--affected cannot be used with --watch or --archive")
+
+    archiveStream = None
+    if opts.archive == "-":
+        # The standard output carries the archive: send the messages
+        # to the standard error
+        archiveStream = sys.stdout
+        sys.stdout = sys.stderr
+
+    if not has_pygments and opts.verb:
+        print "warning: pygments module not found: syntax coloring disabled"
+
+    if opts.cachedir is not None:
+        parseCache.setCacheDir(opts.cachedir)
+
+    filePath = args[0]
+    if opts.affected:
+        # only the paths of the pages are printed
+        handler = DocHandler()
+        if not opts.verb: handler.verbosity = 0
+        try:
+            loadSite(handler, filePath, opts)
+        except DocError, e:
+            print e
+            sys.exit(-1)
+        graph = handler.getIncludeGraph()
+        for affectedPath in opts.affected:
+            if not graph.hasFile(affectedPath):
+                sys.stderr.write("warning: '%s' is not an input file of "
+                                 "the document\n" % affectedPath)
+        for page in graph.getAffectedPages(opts.affected):
+            print page.getPublishPath()
+        sys.exit(0)
+
+    previewServer = None
+    previewPages = None
+    if opts.serve is not None:
+        try:
+            previewServer = PreviewServer(opts.serve, opts.outdir)
+        except EnvironmentError, e:
+            print "error: cannot serve the pages: %s" % e
+            sys.exit(-1)
+        previewPages = previewServer.pages
+
+    handler = DocHandler()
     try:
-        handler.rootNode.publish()
+        loadSite(handler, filePath, opts)
+        publishSite(handler, opts, opts.incremental, archiveStream,
+                    previewPages)
     except DocError, e:
         print e
-        sys.exit(-1)
+        if not opts.watch: sys.exit(-1)
+        handler.rootNode = None
+
+    if opts.watch:
+        if previewServer is not None: previewServer.start()
+        watcher = SiteWatcher(handler, filePath, opts, previewPages)
+        try:
+            watcher.watch()
+        except KeyboardInterrupt:
+            pass
     sys.exit(0)